@@ -3,23 +3,46 @@ import re
 import os
 import sys
 import json
+import ssl
 import time
-from base64 import b64decode
+import fcntl
+import atexit
+import socket
+import random
+import shlex
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from io import BytesIO
+from base64 import b64decode, b64encode
+from http import client as http_client
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib import parse
-from urllib import request as request_
 from urllib.parse import urlencode
-from urllib.error import HTTPError
+from urllib.request import getproxies, proxy_bypass
 
 
-def is_expired(jwt, now):
+def jwt_claims(jwt):
     parts = jwt.split('.', 2)
     if len(parts) != 3:
         raise RequestException('JWT is invalid: {}'.format(jwt))
-    data = b64decode((parts[1] + '==')).decode('utf-8')
-    data = json.loads(data)
+    data = b64decode((parts[1] + '=='), altchars=b'-_').decode('utf-8')
+    return json.loads(data)
+
+
+def jwt_expiry(jwt):
+    data = jwt_claims(jwt)
     if 'exp' not in data:
         raise RequestException('JWT expiration not found: {}'.format(data))
-    return int(data['exp']) <= now
+    return int(data['exp'])
+
+
+def is_expired(jwt, now):
+    return jwt_expiry(jwt) <= now
 
 
 class RequestException(Exception):
@@ -38,6 +61,14 @@ class ResponseException(Exception):
         self.response = response
 
 
+class PaginationException(Exception):
+    url = None
+
+    def __init__(self, msg, url=None):
+        super(PaginationException, self).__init__(msg)
+        self.url = url
+
+
 class ConfigException(Exception):
     config = None
 
@@ -46,14 +77,412 @@ class ConfigException(Exception):
         self.config = config
 
 
+class PooledResponse(object):
+    status = None
+    reason = None
+    headers = None
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = BytesIO(body)
+
+    def __str__(self):
+        return self.reason
+
+    def read(self, size=-1):
+        return self.body.read(size)
+
+
+class ConnectionPool(object):
+    timeout = 60
+    maxsize = 8
+    # errors raised when a kept-alive connection was closed by the server
+    # while idle in the pool, which are safe to retry on a new connection
+    stale_errors = (http_client.RemoteDisconnected,
+                    http_client.CannotSendRequest,
+                    ConnectionResetError,
+                    BrokenPipeError)
+
+    def __init__(self, timeout=None, maxsize=None):
+        if timeout is not None:
+            self.timeout = timeout
+        if maxsize is not None:
+            self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.proxies = {}
+        self.ssl_context = ssl.create_default_context()
+
+    def proxy_for(self, key):
+        """The (host, port, headers) of the proxy for key, from *_proxy.
+
+        Looked up once per key, honoring no_proxy like urllib does.
+        """
+        if key not in self.proxies:
+            scheme, host, port = key
+            proxy = getproxies().get(scheme)
+            if proxy is None or proxy_bypass(host):
+                self.proxies[key] = None
+            else:
+                if '//' not in proxy:
+                    proxy = 'http://' + proxy
+                proxy = parse.urlsplit(proxy)
+                headers = {}
+                if proxy.username is not None:
+                    credentials = '{}:{}'.format(
+                        parse.unquote(proxy.username),
+                        parse.unquote(proxy.password or ''))
+                    headers['Proxy-Authorization'] = 'Basic {}'.format(
+                        b64encode(credentials.encode('utf-8')).decode())
+                self.proxies[key] = (proxy.hostname, proxy.port or 80, headers)
+        return self.proxies[key]
+
+    def new_connection(self, key):
+        scheme, host, port = key
+        proxy = self.proxy_for(key)
+        if proxy is None:
+            if scheme == 'https':
+                return http_client.HTTPSConnection(host, port,
+                                                   timeout=self.timeout,
+                                                   context=self.ssl_context)
+            return http_client.HTTPConnection(host, port,
+                                              timeout=self.timeout)
+        proxy_host, proxy_port, headers = proxy
+        if scheme == 'https':
+            # CONNECT through the proxy, then TLS with the API host
+            conn = http_client.HTTPSConnection(proxy_host, proxy_port,
+                                               timeout=self.timeout,
+                                               context=self.ssl_context)
+            conn.set_tunnel(host, port, headers)
+            return conn
+        # plain http goes to the proxy with absolute URLs, see urlopen
+        return http_client.HTTPConnection(proxy_host, proxy_port,
+                                          timeout=self.timeout)
+
+    def connect(self, conn, timings):
+        if metrics is None or conn._tunnel_host:
+            start = time.perf_counter()
+            conn.connect()
+            timings['connect'] = time.perf_counter() - start
+            return
+        # the same steps as HTTPConnection.connect, split up so that each
+        # phase can be timed
+        start = time.perf_counter()
+        addrs = socket.getaddrinfo(conn.host, conn.port, 0,
+                                   socket.SOCK_STREAM)
+        timings['dns'] = time.perf_counter() - start
+        start = time.perf_counter()
+        sock = self.connect_any(addrs)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        timings['connect'] = time.perf_counter() - start
+        if isinstance(conn, http_client.HTTPSConnection):
+            start = time.perf_counter()
+            sock = self.ssl_context.wrap_socket(sock,
+                                                server_hostname=conn.host)
+            timings['tls'] = time.perf_counter() - start
+        conn.sock = sock
+
+    def connect_any(self, addrs):
+        # try each address in turn like socket.create_connection, so a host
+        # that resolves to an unreachable IPv6 address still connects
+        error = None
+        for family, type, proto, _, addr in addrs:
+            sock = socket.socket(family, type, proto)
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(addr)
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+        raise error or OSError('getaddrinfo returned an empty list')
+
+    def acquire(self, key):
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop(), True
+        return self.new_connection(key), False
+
+    def release(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxsize:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def urlopen(self, method, url, body=None, headers=None):
+        parts = parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '?'.join([path, parts.query])
+        headers = dict(headers or {})
+        proxy = self.proxy_for(key)
+        if proxy is not None and parts.scheme == 'http':
+            path = url
+            headers.update(proxy[2])
+        while True:
+            conn, reused = self.acquire(key)
+            timings = {}
+            start = time.perf_counter()
+            try:
+                if not reused:
+                    self.connect(conn, timings)
+                sent = time.perf_counter()
+                conn.request(method, path, body=body, headers=headers)
+                res = conn.getresponse()
+                timings['first_byte'] = time.perf_counter() - sent
+                data = res.read()
+                timings['total'] = time.perf_counter() - start
+            except self.stale_errors:
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if res.will_close:
+                conn.close()
+            else:
+                self.release(key, conn)
+            if metrics is not None:
+                metrics.record(method=method, url=url, status=res.status,
+                               reused=reused, bytes=len(data), **timings)
+            return PooledResponse(res.status, res.reason, res.headers, data)
+
+
+class Metrics(object):
+    """Request timings and counters collected while profiling."""
+    phases = ['dns', 'connect', 'tls', 'first_byte', 'total', 'json_decode']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.samples = {}
+        self.counters = {}
+
+    def record(self, **entry):
+        with self.lock:
+            self.requests.append(entry)
+            for phase in self.phases:
+                if phase in entry:
+                    self.samples.setdefault(phase, []).append(entry[phase])
+            self.counters['requests'] = self.counters.get('requests', 0) + 1
+            self.counters['bytes'] = self.counters.get('bytes', 0) + \
+                entry.get('bytes', 0)
+            if not entry.get('reused'):
+                self.counters['connections'] = \
+                    self.counters.get('connections', 0) + 1
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.samples.setdefault(phase, []).append(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        rows = []
+        for phase in self.phases:
+            values = sorted(self.samples.get(phase, []))
+            if not values:
+                continue
+            rows.append({
+                'phase': phase,
+                'count': len(values),
+                'total': sum(values),
+                'mean': sum(values) / len(values),
+                'p50': values[int(0.5 * (len(values) - 1))],
+                'p95': values[int(0.95 * (len(values) - 1))],
+                'max': values[-1],
+            })
+        return rows
+
+    def write_table(self, fp):
+        print('{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+            'phase', 'count', 'total_s', 'mean_ms', 'p50_ms', 'p95_ms',
+            'max_ms'), file=fp)
+        for row in self.summary():
+            print('{:<16}{:>8}{:>10.3f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'
+                  .format(row['phase'], row['count'], row['total'],
+                          row['mean'] * 1000, row['p50'] * 1000,
+                          row['p95'] * 1000, row['max'] * 1000), file=fp)
+        for name, value in sorted(self.counters.items()):
+            print('{:<16}{:>8}'.format(name, value), file=fp)
+
+    def write_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump({'summary': self.summary(), 'counters': self.counters,
+                       'requests': self.requests}, f, indent=2)
+
+
+metrics = None
+
+
+def enable_metrics():
+    global metrics
+    if metrics is None:
+        metrics = Metrics()
+    return metrics
+
+
+connection_pool = ConnectionPool()
+
+
+def urlopen(method, url, body=None, headers=None):
+    return connection_pool.urlopen(method, url, body, headers)
+
+
+class RequestScheduler(object):
+    """Client side rate limiting and retries shared by all requests.
+
+    A token bucket of rate requests per second (burst deep) paces requests
+    across threads, X-RateLimit-*/Retry-After headers pause every sender,
+    and idempotent requests are retried with jittered exponential backoff
+    on 429, 5xx and connection errors.
+    """
+    retry_methods = ('GET', 'HEAD')
+    retry_statuses = (429, 500, 502, 503, 504)
+    max_retries = 5
+    backoff = 0.5
+    max_backoff = 30
+    rate = None
+    burst = None
+
+    def __init__(self, rate=None, burst=None, max_retries=None):
+        if rate:
+            self.rate = rate
+            self.burst = burst or max(1, int(rate))
+        if max_retries is not None:
+            self.max_retries = max_retries
+        self.tokens = self.burst or 0
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+        self.retries = 0
+
+    def reserve(self):
+        # take a token and return None, or return how long to wait first
+        with self.lock:
+            wait = self.paused_until - time.time()
+            if wait <= 0:
+                if self.rate is None:
+                    return None
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return None
+                wait = (1 - self.tokens) / self.rate
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        while wait is not None:
+            time.sleep(wait)
+            wait = self.reserve()
+
+    async def acquire_async(self):
+        wait = self.reserve()
+        while wait is not None:
+            await asyncio.sleep(wait)
+            wait = self.reserve()
+
+    def pause(self, until):
+        with self.lock:
+            self.paused_until = max(self.paused_until, until)
+
+    def observe(self, res):
+        remaining = res.headers.get('X-RateLimit-Remaining')
+        reset = res.headers.get('X-RateLimit-Reset')
+        if remaining is not None and reset is not None:
+            try:
+                if int(remaining) <= 0:
+                    self.pause(float(reset))
+            except ValueError:
+                pass
+        retry_after = res.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                self.pause(time.time() + float(retry_after))
+            except ValueError:
+                try:
+                    self.pause(parsedate_to_datetime(retry_after).timestamp())
+                except (TypeError, ValueError):
+                    pass
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def send(self, method, url, body=None, headers=None):
+        retry = method in self.retry_methods
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                res = urlopen(method, url, body, headers)
+            except (OSError, http_client.HTTPException):
+                if not retry or attempt >= self.max_retries:
+                    raise
+            else:
+                self.observe(res)
+                if not retry or attempt >= self.max_retries or \
+                        res.status not in self.retry_statuses:
+                    return res
+            time.sleep(self.delay(attempt))
+            attempt += 1
+            self.count_retry()
+
+    async def send_async(self, pool, method, url, body=None, headers=None):
+        """send() through an AsyncConnectionPool, waiting on the loop."""
+        retry = method in self.retry_methods
+        attempt = 0
+        while True:
+            await self.acquire_async()
+            try:
+                res = await pool.urlopen(method, url, body, headers)
+            except (OSError, http_client.HTTPException,
+                    asyncio.TimeoutError):
+                if not retry or attempt >= self.max_retries:
+                    raise
+            else:
+                self.observe(res)
+                if not retry or attempt >= self.max_retries or \
+                        res.status not in self.retry_statuses:
+                    return res
+            await asyncio.sleep(self.delay(attempt))
+            attempt += 1
+            self.count_retry()
+
+    def count_retry(self):
+        with self.lock:
+            self.retries += 1
+        if metrics is not None:
+            metrics.count('retries')
+
+
 def configure(config):
     url = '/'.join([config.base_url, 'v2/info'])
-    req = request_.Request(url)
-    try:
-        res = request_.urlopen(req)
-    except HTTPError as e:
+    res = urlopen('GET', url)
+    if not 200 <= res.status < 300:
         raise ResponseException('Error configuring {}.'
-                                .format(e.status), e)
+                                .format(res.status), res)
     config.info = json.load(res)
     return config
 
@@ -77,15 +506,174 @@ def authenticate(config):
         data['grant_type'] = 'client_credentials'
     data = parse.urlencode(data).encode('utf-8')
     url = '/'.join([config.info['token_endpoint'], 'oauth/token'])
-    req = request_.Request(url, method='POST', data=data, headers=headers)
-    try:
-        res = request_.urlopen(req)
-    except HTTPError as e:
-        raise ResponseException('Error authenticating {}.'.format(e.status), e)
+    res = urlopen('POST', url, data, headers)
+    if not 200 <= res.status < 300:
+        raise ResponseException('Error authenticating {}.'
+                                .format(res.status), res)
     config.auth = json.load(res)
     return config
 
 
+def configure_cached(config, cache):
+    data = cache.load()
+    if 'info' in data and \
+            time.time() - data.get('info_time', 0) < config.info_ttl:
+        config.info = data['info']
+        return config
+    configure(config)
+    with cache.locked():
+        data = cache.load()
+        data['info'] = config.info
+        data['info_time'] = time.time()
+        cache.save(data)
+    return config
+
+
+class ConfigCache(object):
+    """JSON file holding /v2/info and tokens for one user of one API."""
+    path = None
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_config(cls, config):
+        key = '\0'.join([config.base_url, config.username or '',
+                         config.client_id])
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+        return cls(os.path.join(config.cache_dir, name + '.json'))
+
+    @contextmanager
+    def locked(self):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield self
+        finally:
+            os.close(fd)
+
+    def load(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return {}
+        if st.st_mode & 0o077 or st.st_uid != os.getuid():
+            raise ConfigException('Cache {} must only be accessible by its '
+                                  'owner.'.format(self.path))
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def save(self, data):
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+
+class TokenManager(object):
+    refresh_margin = 60
+    config = None
+    cache = None
+    expires_at = None
+    margin = None
+    timer = None
+
+    def __init__(self, config, cache=None):
+        self.config = config
+        self.cache = cache
+        self.lock = threading.RLock()
+        self.refresh_count = 0
+        if self.config.auth is not None:
+            self.set_auth(self.config.auth)
+
+    def set_auth(self, auth):
+        self.config.auth = auth
+        self.expires_at = jwt_expiry(auth['access_token'])
+        self.margin = self.token_margin(auth)
+
+    def token_margin(self, auth):
+        # a token living less than twice refresh_margin would be expiring
+        # as soon as it is issued, so refresh those halfway through instead
+        expires_at = jwt_expiry(auth['access_token'])
+        issued_at = jwt_claims(auth['access_token']).get('iat', time.time())
+        return min(self.refresh_margin, max(expires_at - issued_at, 0) / 2)
+
+    def expiring(self, auth=None):
+        if auth is not None:
+            expires_at = jwt_expiry(auth['access_token'])
+            margin = self.token_margin(auth)
+        elif self.config.auth is not None:
+            expires_at = self.expires_at
+            margin = self.margin
+        else:
+            return True
+        return expires_at - margin <= time.time()
+
+    def access_token(self):
+        with self.lock:
+            if self.expiring():
+                self.refresh()
+            return self.config.auth['access_token']
+
+    def refresh(self):
+        with self.lock:
+            if self.cache is None:
+                self.authenticate()
+            else:
+                with self.cache.locked():
+                    data = self.cache.load()
+                    auth = data.get('auth')
+                    # another invocation may already have refreshed it
+                    if auth is not None and not self.expiring(auth):
+                        self.set_auth(auth)
+                    else:
+                        self.authenticate()
+                        data['auth'] = self.config.auth
+                        self.cache.save(data)
+            self.schedule()
+
+    def authenticate(self):
+        try:
+            authenticate(self.config)
+        except (RequestException, ResponseException):
+            if self.config.auth is None:
+                raise
+            # the refresh token is unusable, so start a new grant
+            self.config.auth = None
+            authenticate(self.config)
+        self.set_auth(self.config.auth)
+        self.refresh_count += 1
+        if metrics is not None:
+            metrics.count('auth_refreshes')
+
+    def schedule(self):
+        self.stop()
+        delay = self.expires_at - self.margin - time.time()
+        if delay <= 0:
+            # already expiring, the next access_token() call refreshes
+            return
+        self.timer = threading.Timer(delay, self.refresh_background)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def refresh_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            # the next access_token() call retries in the foreground
+            pass
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
 class Config(object):
     base_url = os.getenv('CF_URL')
     version = os.getenv('CF_VERSION', 'v2')
@@ -93,8 +681,14 @@ class Config(object):
     password = os.getenv('CF_PASSWORD')
     client_id = os.getenv('CLIENT_ID', 'cf')
     client_secret = os.getenv('CLIENT_SECRET', '')
+    cache_dir = os.getenv('CF_CACHE_DIR',
+                          os.path.expanduser('~/.cache/cf_api'))
+    info_ttl = int(os.getenv('CF_INFO_TTL', '3600'))
+    rate_limit = float(os.getenv('CF_RATE_LIMIT', '0')) or None
     info = None
     auth = None
+    tokens = None
+    scheduler = None
 
     def assert_info(self):
         if self.info is None:
@@ -108,10 +702,17 @@ class Config(object):
 
 class Resource(object):
     data = None
+    included = None
 
     def __init__(self, data):
         self.data = data
 
+    def related(self, name):
+        """Return the sideloaded resource of relationship name, if any."""
+        if self.included is None:
+            return None
+        return self.included.get(name)
+
     def __repr__(self):
         name = str(self.host or self.label or self.name)
         return '\t'.join([self.guid, name])
@@ -125,6 +726,9 @@ class Resource(object):
     def __contains__(self, name):
         return name in self.data
 
+    def compact(self, keep_raw=True):
+        return CompactResource(self, keep_raw)
+
 
 class V2Resource(Resource):
 
@@ -186,6 +790,80 @@ class V3Resource(Resource):
             return None
 
 
+class CompactResource(object):
+    """Slotted copy of the commonly used fields of a V2/V3 resource.
+
+    The raw response dict is kept for item access unless keep_raw is False,
+    in which case only the extracted fields remain.
+    """
+    __slots__ = ('guid', 'name', 'host', 'label', 'space_guid',
+                 'organization_guid', 'included', 'raw')
+    fields = __slots__[:-2]
+
+    def __init__(self, resource, keep_raw=True):
+        self.guid = resource.guid
+        self.name = resource.name
+        self.host = resource.host
+        self.label = resource.label
+        # relationship guids repeat across many resources, so share them
+        self.space_guid = intern_str(resource.space_guid)
+        self.organization_guid = intern_str(resource.organization_guid)
+        self.included = resource.included
+        self.raw = resource.data if keep_raw else None
+
+    __repr__ = Resource.__repr__
+    related = Resource.related
+
+    @property
+    def data(self):
+        if self.raw is not None:
+            return self.raw
+        return {name: getattr(self, name) for name in self.fields}
+
+    def __getattr__(self, name):
+        if self.raw is None or name not in self.raw:
+            raise AttributeError(name)
+        return self.raw[name]
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def __contains__(self, name):
+        return name in self.data
+
+
+def intern_str(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def benchmark_resources(count=100000):
+    import timeit
+    import tracemalloc
+
+    def make(i):
+        return {'guid': 'guid-{}'.format(i), 'name': 'app-{}'.format(i),
+                'state': 'STARTED', 'lifecycle': {'type': 'buildpack'},
+                'relationships': {'space': {'data': {
+                    'guid': 'space-{}'.format(i % 100)}}}}
+
+    results = []
+    for label, build in [
+            ('V3Resource', lambda d: V3Resource(d)),
+            ('CompactResource', lambda d: V3Resource(d).compact()),
+            ('CompactResource(keep_raw=False)',
+             lambda d: V3Resource(d).compact(False))]:
+        tracemalloc.start()
+        items = [build(make(i)) for i in range(count)]
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        access = timeit.timeit(
+            lambda: [(r.guid, r.name, r.space_guid) for r in items], number=1)
+        results.append({'class': label, 'count': count,
+                        'memory_bytes': memory,
+                        'access_seconds': round(access, 4)})
+    return results
+
+
 class Response(object):
     resource_class = Resource
     response = None
@@ -193,7 +871,10 @@ class Response(object):
 
     def __init__(self, response):
         self.response = response
+        start = time.perf_counter()
         self.data = json.load(response)
+        if metrics is not None:
+            metrics.add('json_decode', time.perf_counter() - start)
 
     def assert_ok(self):
         raise ResponseException('Response.assert_ok() not implemented.')
@@ -227,6 +908,10 @@ class V2Response(Response):
     def next_url(self):
         return self.data.get('next_url', None)
 
+    @property
+    def total_pages(self):
+        return self.data.get('total_pages', None)
+
     def assert_ok(self):
         if not self.ok:
             if 'error_code' in self.data:
@@ -240,6 +925,7 @@ class V2Response(Response):
 
 class V3Response(Response):
     resource_class = V3Resource
+    included_resources = None
 
     @property
     def next_url(self):
@@ -250,6 +936,42 @@ class V3Response(Response):
             return self.data['pagination']['next']['href']
         return None
 
+    @property
+    def total_pages(self):
+        return self.data.get('pagination', {}).get('total_pages', None)
+
+    @property
+    def resources(self):
+        return self.link_included(super(V3Response, self).resources)
+
+    @property
+    def resource(self):
+        return self.link_included([super(V3Response, self).resource])[0]
+
+    @property
+    def included(self):
+        """Sideloaded resources from include=, keyed by type then guid."""
+        if self.included_resources is None:
+            self.included_resources = {
+                kind: {r['guid']: self.resource_class(r) for r in items}
+                for kind, items in self.data.get('included', {}).items()
+            }
+        return self.included_resources
+
+    def link_included(self, resources):
+        included = self.included
+        if not included:
+            return resources
+        linked = [r for items in included.values() for r in items.values()]
+        for r in resources + linked:
+            r.included = {}
+            for name, rel in r.data.get('relationships', {}).items():
+                guid = (rel.get('data') or {}).get('guid')
+                kind = included.get(name + 's', {})
+                if guid in kind:
+                    r.included[name] = kind[guid]
+        return resources
+
     def assert_ok(self):
         if not self.ok:
             if 'errors' in self.data:
@@ -266,6 +988,7 @@ class V3Response(Response):
 
 class Request(object):
     response_class = Resource
+    version = None
     config = None
     method = None
     body = None
@@ -279,7 +1002,7 @@ class Request(object):
     def set_url(self, path, **query):
         path = re.sub(r'^(https?://[^/]+)?/(v\d+/)?', '', path)
         parts = list(parse.urlsplit(self.config.base_url))
-        parts[2] = '/'.join([self.config.version, path])
+        parts[2] = '/'.join([self.version or self.config.version, path])
         parts[3] = urlencode(query)
         self.url = parse.urlunsplit(parts)
         return self
@@ -290,18 +1013,17 @@ class Request(object):
         return self
 
     def send(self, method):
-        if self.config.auth is None or \
-                is_expired(self.config.auth['access_token'], time.time()):
-            authenticate(self.config)
-        auth = 'bearer {}'.format(self.config.auth['access_token'])
+        if self.config.tokens is None:
+            self.config.tokens = TokenManager(self.config)
+        auth = 'bearer {}'.format(self.config.tokens.access_token())
         headers = {'Authorization': auth,
                    'Accept': 'application/json'}
-        req = request_.Request(self.url, method=method, data=self.body,
-                               headers=headers)
-        try:
-            res = request_.urlopen(req)
-        except HTTPError as e:
-            res = e
+        headers.update(self.headers)
+        if self.config.scheduler is not None:
+            res = self.config.scheduler.send(method, self.url, self.body,
+                                             headers)
+        else:
+            res = urlopen(method, self.url, self.body, headers)
         return self.response_class(res)
 
     def get(self):
@@ -319,29 +1041,413 @@ class Request(object):
 
 class V2Request(Request):
     response_class = V2Response
+    version = 'v2'
 
 
 class V3Request(Request):
     response_class = V3Response
+    version = 'v3'
 
 
 class CloudController(object):
     request_class = None
     config = None
+    max_url_length = 4000
 
     def __init__(self, config, request_class=V2Request):
         self.config = config
         self.request_class = request_class
+        self.resolved = {}
 
     def request(self, path, **query):
         return self.request_class(self.config, path, **query)
 
+    def resolve(self, path, guids, include=None, **query):
+        """Fetch V3 resources by guid using chunked guids= filters.
+
+        Results, and any resources sideloaded through include=, are cached
+        so later calls only request guids not seen before. Returns one
+        V3Resource (or None when not found) per requested guid.
+        """
+        kind = path.strip('/').split('/')[-1]
+        cache = self.resolved.setdefault(kind, {})
+        missing = list(dict.fromkeys(g for g in guids
+                                     if g is not None and g not in cache))
+        if include is not None:
+            query['include'] = include
+        query['per_page'] = 5000
+        for chunk in self.guid_chunks(path, missing, **query):
+            req = V3Request(self.config, path, guids=','.join(chunk), **query)
+            while True:
+                res = req.get()
+                for r in res.resources:
+                    cache[r.guid] = r
+                for name, items in res.included.items():
+                    self.resolved.setdefault(name, {}).update(items)
+                if res.next_url is None:
+                    break
+                req.set_url(res.next_url)
+        return [cache.get(g) for g in guids]
+
+    def guid_chunks(self, path, guids, **query):
+        # keep each filtered URL under max_url_length, counting the guids
+        # as they will be encoded (a comma is sent as %2C)
+        base = len(V3Request(self.config, path, guids='', **query).url)
+        chunk, length = [], base
+        for guid in guids:
+            size = len(parse.quote(guid, safe='')) + 3
+            if chunk and length + size > self.max_url_length:
+                yield chunk
+                chunk, length = [], base
+            chunk.append(guid)
+            length += size
+        if chunk:
+            yield chunk
+
+    def resolve_spaces(self, resources):
+        """Attach space and organization to resources in bulk.
+
+        Works for V2, V3 and compact resources alike, the spaces are
+        always fetched through the V3 API.
+        """
+        spaces = self.resolve('spaces', [r.space_guid for r in resources],
+                              include='organization')
+        for r, space in zip(resources, spaces):
+            if space is None:
+                continue
+            if r.included is None:
+                r.included = {}
+            r.included['space'] = space
+            r.included['organization'] = space.related('organization')
+        return resources
+
+
+def get_page(req):
+    if metrics is not None:
+        metrics.count('pages')
+    try:
+        res = req.get()
+        return res, res.resources
+    except (ResponseException, OSError, http_client.HTTPException) as e:
+        raise PaginationException('Listing stopped at {}: {}'
+                                  .format(req.url, e), req.url) from e
+
 
 def get_all_resources(req, verbose=False):
     while True:
         if verbose:
             print(req.url, file=sys.stderr)
-        res = req.get()
+        res, resources = get_page(req)
+        for r in resources:
+            yield r
+        if res.next_url is None:
+            break
+        req.set_url(res.next_url)
+
+
+def page_url(url, page):
+    parts = list(parse.urlsplit(url))
+    query = [(k, v) for k, v in parse.parse_qsl(parts[3], True)
+             if k != 'page']
+    query.append(('page', str(page)))
+    parts[3] = urlencode(query)
+    return parse.urlunsplit(parts)
+
+
+def get_all_resources_parallel(req, concurrency=4, verbose=False):
+    if verbose:
+        print(req.url, file=sys.stderr)
+    res, resources = get_page(req)
+    for r in resources:
+        yield r
+    if res.next_url is None or not res.total_pages:
+        return
+    urls = deque(page_url(res.next_url, page)
+                 for page in range(2, res.total_pages + 1))
+
+    def fetch(url):
+        if verbose:
+            print(url, file=sys.stderr)
+        return get_page(req.__class__(req.config, url))[1]
+
+    # keep a bounded window of in-flight pages so that a slow consumer does
+    # not cause every remaining page to be buffered in memory
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = deque()
+        while urls or pending:
+            while urls and len(pending) < concurrency * 2:
+                pending.append(pool.submit(fetch, urls.popleft()))
+            for r in pending.popleft().result():
+                yield r
+
+
+class AsyncConnectionPool(object):
+    """Keep-alive HTTP/1.1 connections on asyncio streams.
+
+    The event loop counterpart of ConnectionPool, with the same proxy
+    handling and metrics. Responses are PooledResponse objects, so the
+    V2/V3 response classes work on them unchanged.
+    """
+    timeout = 60
+    maxsize = 8
+    stale_errors = ConnectionPool.stale_errors
+
+    def __init__(self, timeout=None, maxsize=None):
+        if timeout is not None:
+            self.timeout = timeout
+        if maxsize is not None:
+            self.maxsize = maxsize
+        self.idle = {}
+        self.proxies = {}
+        self.ssl_context = ssl.create_default_context()
+
+    proxy_for = ConnectionPool.proxy_for
+
+    async def connect(self, key, timings):
+        scheme, host, port = key
+        port = port or (443 if scheme == 'https' else 80)
+        context = self.ssl_context if scheme == 'https' else None
+        proxy = self.proxy_for(key)
+        start = time.perf_counter()
+        if proxy is None:
+            streams = await asyncio.wait_for(asyncio.open_connection(
+                host, port, ssl=context), self.timeout)
+        else:
+            streams = await asyncio.wait_for(asyncio.open_connection(
+                proxy[0], proxy[1]), self.timeout)
+            if context is not None:
+                await self.tunnel(streams, host, port, proxy[2])
+                await asyncio.wait_for(streams[1].start_tls(
+                    context, server_hostname=host), self.timeout)
+        timings['connect'] = time.perf_counter() - start
+        return streams
+
+    async def tunnel(self, streams, host, port, headers):
+        reader, writer = streams
+        lines = ['CONNECT {0}:{1} HTTP/1.1'.format(host, port),
+                 'Host: {0}:{1}'.format(host, port)]
+        lines.extend('{}: {}'.format(*h) for h in headers.items())
+        writer.write('\r\n'.join(lines + ['', '']).encode('latin-1'))
+        status, reason, _ = await self.read_head(reader)
+        if status != 200:
+            writer.close()
+            raise OSError('Tunnel connection failed: {} {}'
+                          .format(status, reason))
+
+    async def read_head(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise http_client.RemoteDisconnected(
+                'Remote end closed connection without response')
+        parts = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise http_client.BadStatusLine(line)
+        head = b''
+        while True:
+            line = await reader.readline()
+            head += line
+            if line in (b'\r\n', b'\n', b''):
+                break
+        headers = http_client.parse_headers(BytesIO(head))
+        return int(parts[1]), parts[2] if len(parts) > 2 else '', headers
+
+    async def read_body(self, reader, method, status, headers):
+        # returns the body and whether the connection can be kept alive
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            return b'', True
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            chunks = []
+            while True:
+                size = await reader.readline()
+                size = int(size.split(b';', 1)[0].strip() or b'0', 16)
+                if size == 0:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            # skip any trailers up to the final empty line
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            return b''.join(chunks), True
+        length = headers.get('Content-Length')
+        if length is not None:
+            return await reader.readexactly(int(length)), True
+        return await reader.read(), False
+
+    async def urlopen(self, method, url, body=None, headers=None):
+        parts = parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '?'.join([path, parts.query])
+        headers = dict(headers or {})
+        proxy = self.proxy_for(key)
+        if proxy is not None and parts.scheme == 'http':
+            path = url
+            headers.update(proxy[2])
+        headers.setdefault('Host', parts.netloc.rsplit('@', 1)[-1])
+        if body is not None or method in ('POST', 'PUT', 'PATCH'):
+            headers['Content-Length'] = str(len(body or b''))
+        lines = ['{} {} HTTP/1.1'.format(method, path)]
+        lines.extend('{}: {}'.format(*h) for h in headers.items())
+        request = '\r\n'.join(lines + ['', '']).encode('latin-1')
+        while True:
+            conns = self.idle.get(key)
+            reused = bool(conns)
+            timings = {}
+            start = time.perf_counter()
+            try:
+                if reused:
+                    reader, writer = conns.pop()
+                else:
+                    reader, writer = await self.connect(key, timings)
+            except asyncio.TimeoutError:
+                raise socket.timeout('timed out connecting to {}'
+                                     .format(parts.netloc))
+            try:
+                sent = time.perf_counter()
+                writer.write(request + (body or b''))
+                await writer.drain()
+                status, reason, res_headers = await asyncio.wait_for(
+                    self.read_head(reader), self.timeout)
+                timings['first_byte'] = time.perf_counter() - sent
+                data, keep_alive = await asyncio.wait_for(
+                    self.read_body(reader, method, status, res_headers),
+                    self.timeout)
+                timings['total'] = time.perf_counter() - start
+            except asyncio.IncompleteReadError as e:
+                writer.close()
+                if reused:
+                    continue
+                raise http_client.IncompleteRead(e.partial)
+            except self.stale_errors:
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except asyncio.TimeoutError:
+                writer.close()
+                raise socket.timeout('timed out reading from {}'
+                                     .format(parts.netloc))
+            except BaseException:
+                writer.close()
+                raise
+            if not keep_alive or \
+                    'close' in res_headers.get('Connection', '').lower():
+                writer.close()
+            else:
+                conns = self.idle.setdefault(key, [])
+                if len(conns) < self.maxsize:
+                    conns.append((reader, writer))
+                else:
+                    writer.close()
+            if metrics is not None:
+                metrics.record(method=method, url=url, status=status,
+                               reused=reused, bytes=len(data), **timings)
+            return PooledResponse(status, reason, res_headers, data)
+
+    async def close(self):
+        idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for _, writer in conns:
+                writer.close()
+
+
+class AsyncRequest(object):
+    """Awaitable counterpart of a Request, sent on the controller's pool.
+
+    The request is written on asyncio streams, so any number of them can
+    be in flight on one event loop, bounded only by the controller's
+    concurrency. Responses use the same V2/V3 response classes.
+    """
+    controller = None
+    request = None
+
+    def __init__(self, controller, request):
+        self.controller = controller
+        self.request = request
+
+    @property
+    def url(self):
+        return self.request.url
+
+    def set_url(self, path, **query):
+        self.request.set_url(path, **query)
+        return self
+
+    def set_body(self, body):
+        self.request.set_body(body)
+        return self
+
+    async def send(self, method):
+        config = self.controller.config
+        async with self.controller.semaphore:
+            if config.tokens.expiring():
+                # refreshing talks to UAA on the blocking client
+                loop = asyncio.get_running_loop()
+                token = await loop.run_in_executor(
+                    None, config.tokens.access_token)
+            else:
+                token = config.auth['access_token']
+            headers = {'Authorization': 'bearer {}'.format(token),
+                       'Accept': 'application/json'}
+            headers.update(self.request.headers)
+            pool = self.controller.pool
+            if config.scheduler is not None:
+                res = await config.scheduler.send_async(
+                    pool, method, self.request.url, self.request.body,
+                    headers)
+            else:
+                res = await pool.urlopen(method, self.request.url,
+                                         self.request.body, headers)
+        return self.request.response_class(res)
+
+    async def get(self):
+        return await self.send('GET')
+
+    async def post(self):
+        return await self.send('POST')
+
+    async def put(self):
+        return await self.send('PUT')
+
+    async def delete(self):
+        return await self.send('DELETE')
+
+
+class AsyncCloudController(object):
+    request_class = None
+    config = None
+    concurrency = 64
+
+    def __init__(self, config, request_class=V2Request, concurrency=None):
+        self.config = config
+        self.request_class = request_class
+        if concurrency is not None:
+            self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.pool = AsyncConnectionPool(maxsize=self.concurrency)
+        if self.config.tokens is None:
+            self.config.tokens = TokenManager(self.config)
+
+    def request(self, path, **query):
+        return AsyncRequest(self, self.request_class(self.config, path,
+                                                     **query))
+
+    async def close(self):
+        await self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+async def get_all_resources_async(req, verbose=False):
+    while True:
+        if verbose:
+            print(req.url, file=sys.stderr)
+        res = await req.get()
         for r in res.resources:
             yield r
         if res.next_url is None:
@@ -349,8 +1455,183 @@ def get_all_resources(req, verbose=False):
         req.set_url(res.next_url)
 
 
+async def fan_out(cc, resources, path, method='GET', verbose=False):
+    """Send one request per resource, formatting path with its fields."""
+    async def send(resource):
+        req = cc.request(path.format(guid=resource.guid, name=resource.name))
+        if verbose:
+            print(req.url, file=sys.stderr)
+        return (await req.send(method)).resources
+
+    tasks = [asyncio.ensure_future(send(r)) for r in resources]
+    try:
+        for task in tasks:
+            for r in await task:
+                yield r
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def run_fan_out(config, request_class, resources, path, method='GET',
+                concurrency=None, verbose=False):
+    async def run():
+        async with AsyncCloudController(config, request_class,
+                                        concurrency) as cc:
+            return [r async for r in fan_out(cc, resources, path, method,
+                                             verbose)]
+    return asyncio.run(run())
+
+
+class Inventory(object):
+    """Local SQLite copy of the foundation, synced through the V3 API.
+
+    Each sync only fetches resources updated since the newest updated_at
+    already stored. Deletions are only picked up by a full sync.
+    """
+    tables = {
+        'organizations': 'organizations',
+        'spaces': 'spaces',
+        'apps': 'apps',
+        'routes': 'routes',
+        'service_instances': 'service_instances',
+        'service_bindings': 'service_credential_bindings',
+    }
+    columns = ['guid', 'name', 'host', 'space_guid', 'organization_guid',
+               'app_guid', 'service_instance_guid', 'updated_at', 'data']
+    db = None
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS sync_state ('
+                            'name TEXT PRIMARY KEY, updated_at TEXT)')
+            for table in self.tables:
+                self.db.execute(
+                    'CREATE TABLE IF NOT EXISTS {} (guid TEXT PRIMARY KEY, '
+                    'name TEXT, host TEXT, space_guid TEXT, '
+                    'organization_guid TEXT, app_guid TEXT, '
+                    'service_instance_guid TEXT, updated_at TEXT, data TEXT)'
+                    .format(table))
+                for column in ['name', 'space_guid', 'organization_guid',
+                               'app_guid', 'service_instance_guid']:
+                    self.db.execute(
+                        'CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})'
+                        .format(table, column))
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def row(resource):
+        relationships = resource.data.get('relationships', {})
+
+        def related(name):
+            try:
+                return relationships[name]['data']['guid']
+            except (KeyError, TypeError):
+                return None
+
+        return (resource.guid, resource.name, resource.host,
+                related('space'), related('organization'), related('app'),
+                related('service_instance'), resource.data.get('updated_at'),
+                json.dumps(resource.data))
+
+    def last_updated(self, table):
+        row = self.db.execute('SELECT updated_at FROM sync_state '
+                              'WHERE name = ?', (table,)).fetchone()
+        return row['updated_at'] if row else None
+
+    def sync(self, config, full=False, verbose=False):
+        counts = {}
+        for table, path in self.tables.items():
+            query = {'order_by': 'updated_at', 'per_page': 5000}
+            since = None if full else self.last_updated(table)
+            if since is not None:
+                # gte rather than gt so that resources sharing the last
+                # timestamp are not missed; the upsert makes it idempotent
+                query['updated_ats[gte]'] = since
+            req = V3Request(config, path, **query)
+            rows = [self.row(r) for r in get_all_resources(req, verbose)]
+            with self.db:
+                if full:
+                    self.db.execute('DELETE FROM {}'.format(table))
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                        table, ', '.join(self.columns),
+                        ', '.join('?' * len(self.columns))), rows)
+                latest = max([r[7] for r in rows if r[7]] + [since or ''])
+                if latest:
+                    self.db.execute('INSERT OR REPLACE INTO sync_state '
+                                    'VALUES (?, ?)', (table, latest))
+            counts[table] = len(rows)
+        return counts
+
+    def find(self, table, key):
+        if table not in self.tables:
+            raise ConfigException('Unknown inventory table {}.'.format(table))
+        if table == 'organizations':
+            org_guid = 't.guid'
+        else:
+            org_guid = 'COALESCE(t.organization_guid, s.organization_guid)'
+        sql = ('SELECT t.guid, t.name, t.host, t.space_guid, '
+               's.name AS space_name, {0} AS organization_guid, '
+               'o.name AS organization_name, t.updated_at FROM {1} t '
+               'LEFT JOIN spaces s ON s.guid = t.space_guid '
+               'LEFT JOIN organizations o ON o.guid = {0} '
+               'WHERE t.guid = ? OR t.name = ? OR t.host = ?'
+               .format(org_guid, table))
+        return [dict(r) for r in self.db.execute(sql, (key, key, key))]
+
+    def bound_apps(self, service_instance):
+        sql = ('SELECT a.guid, a.name, a.space_guid, s.name AS space_name, '
+               'si.guid AS service_instance_guid, '
+               'si.name AS service_instance_name FROM service_bindings b '
+               'JOIN service_instances si ON si.guid = b.service_instance_guid '
+               'JOIN apps a ON a.guid = b.app_guid '
+               'LEFT JOIN spaces s ON s.guid = a.space_guid '
+               'WHERE si.guid = ? OR si.name = ?')
+        return [dict(r) for r in self.db.execute(
+            sql, (service_instance, service_instance))]
+
+
+def dump_json_array(items, fp, indent=2, default=None):
+    # same layout as json.dump(list(items), fp, indent=indent) but each item
+    # is written as soon as it is produced
+    pad = ' ' * indent
+    sep = '[\n'
+    for item in items:
+        data = json.dumps(item, indent=indent, default=default)
+        fp.write(sep + pad + data.replace('\n', '\n' + pad))
+        fp.flush()
+        sep = ',\n'
+    fp.write('[]' if sep == '[\n' else '\n]')
+    fp.flush()
+
+
+def dump_ndjson(items, fp, default=None):
+    for item in items:
+        fp.write(json.dumps(item, default=default) + '\n')
+        fp.flush()
+
+
+def resume_command(argv, url, next_url):
+    """The command line argv with its url argument replaced by next_url."""
+    argv = list(argv)
+    argv[len(argv) - 1 - argv[::-1].index(url)] = next_url
+    return ' '.join(shlex.quote(arg) for arg in argv)
+
+
 def new_cloud_controller(config):
-    configure(config)
+    if config.cache_dir:
+        cache = ConfigCache.for_config(config)
+        configure_cached(config, cache)
+    else:
+        cache = None
+        configure(config)
+    config.tokens = TokenManager(config, cache)
+    config.scheduler = RequestScheduler(config.rate_limit)
     request_class = getattr(sys.modules[__name__],
                             config.version.upper() + 'Request')
     return CloudController(config, request_class)
@@ -363,24 +1644,98 @@ def main():
     args.add_argument('-X', dest='method', default='GET')
     args.add_argument('-d', dest='body', action='store_true')
     args.add_argument('-l', dest='list', action='store_true')
+    args.add_argument('-j', dest='concurrency', type=int,
+                      help='fetch pages concurrently when listing with -l '
+                      '(default 1), requests at a time for --each '
+                      '(default {})'.format(AsyncCloudController.concurrency))
     args.add_argument('-v', dest='verbose', action='store_true')
     args.add_argument('--short', action='store_true')
-    args.add_argument('url')
-    args = args.parse_args()
+    args.add_argument('--ndjson', action='store_true',
+                      help='write one JSON resource per line')
+    args.add_argument('--each', metavar='PATH',
+                      help='send METHOD to PATH for every listed resource, '
+                      'e.g. /v3/apps/{guid}/env')
+    args.add_argument('--profile', action='store_true',
+                      help='print request timing totals to stderr on exit')
+    args.add_argument('--trace', metavar='FILE',
+                      help='write per-request timings as JSON on exit')
+    args.add_argument('--bench-resources', type=int, metavar='COUNT',
+                      help='compare resource class memory and access speed')
+    args.add_argument('--inventory', metavar='DB',
+                      default=os.getenv('CF_INVENTORY'),
+                      help='SQLite inventory used by --sync, --find and '
+                      '--bound-apps')
+    args.add_argument('--sync', action='store_true',
+                      help='fetch resources updated since the last sync')
+    args.add_argument('--full-sync', action='store_true',
+                      help='rebuild the inventory, dropping deleted resources')
+    args.add_argument('--find', nargs=2, metavar=('TABLE', 'KEY'),
+                      help='look up a resource by guid, name or host')
+    args.add_argument('--bound-apps', metavar='SERVICE_INSTANCE',
+                      help='list apps bound to a service instance')
+    args.add_argument('url', nargs='?')
+    parser, args = args, args.parse_args()
+    if args.concurrency is not None and args.concurrency < 1:
+        parser.error('-j must be at least 1')
+    if args.profile or args.trace:
+        profile = enable_metrics()
+        if args.profile:
+            atexit.register(profile.write_table, sys.stderr)
+        if args.trace:
+            atexit.register(profile.write_trace, args.trace)
+    if args.bench_resources:
+        for row in benchmark_resources(args.bench_resources):
+            print(json.dumps(row))
+        return
+    elif args.sync or args.full_sync or args.find or args.bound_apps:
+        if not args.inventory:
+            parser.error('--inventory or CF_INVENTORY is required')
+        inventory = Inventory(args.inventory)
+        if args.sync or args.full_sync:
+            config = Config()
+            new_cloud_controller(config)
+            counts = inventory.sync(config, args.full_sync, args.verbose)
+            print(json.dumps(counts), file=sys.stderr)
+        if args.find:
+            dump_json_array(inventory.find(*args.find), sys.stdout)
+        elif args.bound_apps:
+            dump_json_array(inventory.bound_apps(args.bound_apps), sys.stdout)
+        inventory.close()
+        return
+    elif args.url is None:
+        parser.error('the following arguments are required: url')
     config = Config()
     cc = new_cloud_controller(config)
     req = cc.request(args.url)
     if args.body:
         req.body = sys.stdin.read().encode('utf-8')
-    if args.list:
-        res = get_all_resources(req, args.verbose)
-    else:
-        res = req.send(args.method).resources
-    if args.short:
-        for item in res:
-            print(item)
-    else:
-        json.dump(list(res), sys.stdout, indent=2, default=lambda o: o.data)
+    try:
+        if args.list and (args.concurrency or 1) > 1:
+            res = get_all_resources_parallel(req, args.concurrency,
+                                             args.verbose)
+        elif args.list:
+            res = get_all_resources(req, args.verbose)
+        else:
+            res = req.send(args.method).resources
+        if args.each:
+            res = run_fan_out(config, cc.request_class, list(res), args.each,
+                              args.method if args.list else 'GET',
+                              args.concurrency, args.verbose)
+        if args.short:
+            for item in res:
+                print(item)
+        else:
+            dump = dump_ndjson if args.ndjson else dump_json_array
+            dump(res, sys.stdout, default=lambda o: o.data)
+    except BrokenPipeError:
+        # the reader (e.g. head or jq) went away before the listing ended
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    except PaginationException as e:
+        print(e, file=sys.stderr)
+        print('Resume with: {}'.format(
+            resume_command(sys.argv, args.url, e.url)), file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
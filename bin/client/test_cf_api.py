@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+"""Tests for cf_api.py against local HTTP stand-ins, run it directly."""
+import os
+import sys
+import json
+import time
+import base64
+import asyncio
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cf_api  # noqa: E402
+
+
+class StandIn(object):
+    """A local HTTP server which counts connections and records requests.
+
+    Handler is called with the request handler and returns (status, body).
+    """
+
+    def __init__(self, handler):
+        self.connections = 0
+        self.requests = []
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                stand_in.connections += 1
+                super().setup()
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                stand_in.requests.append((self.command, self.path,
+                                          dict(self.headers), body))
+                status, data = handler(self)
+                data = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_CONNECT = respond
+
+        class Server(ThreadingHTTPServer):
+            request_queue_size = 128
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.url = 'http://127.0.0.1:{}'.format(self.port)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def echo(handler):
+    return 200, {'path': handler.path}
+
+
+def no_proxy_env(**proxies):
+    env = {k: v for k, v in os.environ.items()
+           if not k.lower().endswith('_proxy')}
+    env.update(proxies)
+    return mock.patch.dict(os.environ, env, clear=True)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = cf_api.ConnectionPool(timeout=5)
+        self.addCleanup(self.pool.close)
+
+    def test_keep_alive(self):
+        with no_proxy_env(), StandIn(echo) as server:
+            for i in range(5):
+                res = self.pool.urlopen('GET', '{}/v3/apps?page={}'.format(
+                    server.url, i))
+                self.assertEqual(res.status, 200)
+                self.assertEqual(json.loads(res.read())['path'],
+                                 '/v3/apps?page={}'.format(i))
+            self.assertEqual(server.connections, 1)
+
+    def test_metrics(self):
+        self.addCleanup(setattr, cf_api, 'metrics', cf_api.metrics)
+        cf_api.metrics = cf_api.Metrics()
+        with no_proxy_env(), StandIn(echo) as server:
+            self.pool.urlopen('GET', server.url + '/a')
+            self.pool.urlopen('GET', server.url + '/b')
+        self.assertEqual(server.connections, 1)
+        first, second = cf_api.metrics.requests
+        self.assertEqual(first['url'], server.url + '/a')
+        self.assertFalse(first['reused'])
+        self.assertTrue(second['reused'])
+        for phase in ('dns', 'connect'):
+            self.assertIn(phase, first)
+            self.assertNotIn(phase, second)
+        self.assertNotIn('tls', first)
+        counts = {row['phase']: row['count']
+                  for row in cf_api.metrics.summary()}
+        self.assertEqual(counts, {'dns': 1, 'connect': 1, 'first_byte': 2,
+                                  'total': 2})
+        self.assertEqual(cf_api.metrics.counters['requests'], 2)
+        self.assertEqual(cf_api.metrics.counters['connections'], 1)
+
+    def test_http_proxy(self):
+        with StandIn(echo) as proxy:
+            with no_proxy_env(http_proxy='user:secret@127.0.0.1:{}'.format(
+                    proxy.port)):
+                res = self.pool.urlopen('GET', 'http://cf.invalid/v2/info')
+            self.assertEqual(res.status, 200)
+            method, path, headers, _ = proxy.requests[0]
+            self.assertEqual(path, 'http://cf.invalid/v2/info')
+            self.assertEqual(headers['Host'], 'cf.invalid')
+            self.assertEqual(headers['Proxy-Authorization'],
+                             'Basic dXNlcjpzZWNyZXQ=')
+
+    def test_no_proxy(self):
+        with StandIn(echo) as proxy, StandIn(echo) as server:
+            with no_proxy_env(http_proxy=proxy.url, no_proxy='127.0.0.1'):
+                res = self.pool.urlopen('GET', server.url + '/v2/info')
+            self.assertEqual(res.status, 200)
+            self.assertEqual(proxy.connections, 0)
+            self.assertEqual(server.connections, 1)
+
+    def test_https_proxy_tunnel(self):
+        with StandIn(lambda handler: (502, {})) as proxy:
+            with no_proxy_env(https_proxy=proxy.url):
+                with self.assertRaises(OSError):
+                    self.pool.urlopen('GET', 'https://cf.invalid/v2/info')
+            method, path, _, _ = proxy.requests[0]
+            self.assertEqual((method, path), ('CONNECT', 'cf.invalid:443'))
+
+
+def jwt(exp):
+    payload = json.dumps({'exp': exp}).encode('utf-8')
+    return 'header.{}.signature'.format(
+        base64.urlsafe_b64encode(payload).decode().rstrip('='))
+
+
+def relationship(guid):
+    return {'data': {'guid': guid}}
+
+
+class FakeCloudController(object):
+    """Just enough of the V3 CC API for Inventory.sync.
+
+    Honors updated_ats[gte], per_page (up to max_per_page) and page, and
+    records every query.
+    """
+    max_per_page = 2
+
+    def __init__(self):
+        self.queries = []
+        self.collections = {
+            'organizations': [
+                {'guid': 'org-1', 'name': 'org',
+                 'updated_at': '2020-01-01T00:00:00Z'}],
+            'spaces': [
+                {'guid': 'space-1', 'name': 'dev',
+                 'updated_at': '2020-01-01T00:00:00Z',
+                 'relationships': {'organization': relationship('org-1')}}],
+            'apps': [
+                {'guid': 'app-{}'.format(i), 'name': 'app{}'.format(i),
+                 'updated_at': '2020-01-{:02d}T00:00:00Z'.format(i + 1),
+                 'relationships': {'space': relationship('space-1')}}
+                for i in range(5)],
+            'routes': [
+                {'guid': 'route-1', 'host': 'www',
+                 'updated_at': '2020-01-01T00:00:00Z',
+                 'relationships': {'space': relationship('space-1')}}],
+            'service_instances': [
+                {'guid': 'si-1', 'name': 'db',
+                 'updated_at': '2020-01-01T00:00:00Z',
+                 'relationships': {'space': relationship('space-1')}}],
+            'service_credential_bindings': [
+                {'guid': 'binding-{}'.format(i),
+                 'updated_at': '2020-01-01T00:00:00Z',
+                 'relationships': {'app': relationship('app-{}'.format(i)),
+                                   'service_instance': relationship('si-1')}}
+                for i in (1, 3)],
+        }
+
+    def __call__(self, handler):
+        url = urlsplit(handler.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if handler.command == 'POST':
+            return 200, {'access_token': jwt(int(time.time()) + 600),
+                         'refresh_token': 'refresh'}
+        if url.path == '/v2/info':
+            return 200, {'token_endpoint': self.url}
+        self.queries.append((url.path, dict(query)))
+        items = self.collections[url.path[len('/v3/'):]]
+        if 'updated_ats[gte]' in query:
+            items = [r for r in items
+                     if r['updated_at'] >= query['updated_ats[gte]']]
+        per_page = min(int(query.get('per_page', 50)), self.max_per_page)
+        page = int(query.get('page', 1))
+        total_pages = max(1, -(-len(items) // per_page))
+        next_page = None
+        if page < total_pages:
+            query['page'] = page + 1
+            next_page = {'href': '{}{}?{}'.format(
+                self.url, url.path, urlencode(query))}
+        return 200, {
+            'pagination': {'total_results': len(items),
+                           'total_pages': total_pages, 'next': next_page},
+            'resources': items[(page - 1) * per_page:page * per_page],
+        }
+
+
+class InventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        env = no_proxy_env()
+        env.start()
+        self.addCleanup(env.stop)
+        self.cc = FakeCloudController()
+        server = StandIn(self.cc).__enter__()
+        self.addCleanup(server.__exit__)
+        self.cc.url = server.url
+        self.config = cf_api.Config()
+        self.config.base_url = server.url
+        self.config.version = 'v3'
+        cf_api.configure(self.config)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.inventory = cf_api.Inventory(os.path.join(tmp.name, 'inv.db'))
+        self.addCleanup(self.inventory.close)
+
+    def test_full_sync(self):
+        counts = self.inventory.sync(self.config, full=True)
+        self.assertEqual(counts, {
+            'organizations': 1, 'spaces': 1, 'apps': 5, 'routes': 1,
+            'service_instances': 1, 'service_bindings': 2})
+        for path, query in self.cc.queries:
+            self.assertNotIn('updated_ats[gte]', query)
+        pages = [q.get('page') for path, q in self.cc.queries
+                 if path == '/v3/apps']
+        self.assertEqual(pages, [None, '2', '3'])
+
+    def test_incremental_sync(self):
+        self.inventory.sync(self.config)
+        apps = self.cc.collections['apps']
+        apps[0] = dict(apps[0], name='renamed',
+                       updated_at='2020-02-01T00:00:00Z')
+        self.cc.queries = []
+        counts = self.inventory.sync(self.config)
+        queries = {path: q for path, q in self.cc.queries
+                   if 'page' not in q}
+        self.assertEqual(queries['/v3/apps']['updated_ats[gte]'],
+                         '2020-01-05T00:00:00Z')
+        self.assertEqual(queries['/v3/organizations']['updated_ats[gte]'],
+                         '2020-01-01T00:00:00Z')
+        # the app sharing the last timestamp comes back, and the renamed one
+        self.assertEqual(counts['apps'], 2)
+        self.assertEqual(self.inventory.find('apps', 'renamed')[0]['guid'],
+                         'app-0')
+        self.assertEqual(self.inventory.find('apps', 'app0'), [])
+
+    def test_find(self):
+        self.inventory.sync(self.config)
+        app, = self.inventory.find('apps', 'app2')
+        self.assertEqual(app['guid'], 'app-2')
+        self.assertEqual(app['space_name'], 'dev')
+        self.assertEqual(app['organization_name'], 'org')
+        route, = self.inventory.find('routes', 'www')
+        self.assertEqual(route['guid'], 'route-1')
+        org, = self.inventory.find('organizations', 'org-1')
+        self.assertEqual(org['organization_name'], 'org')
+        with self.assertRaises(cf_api.ConfigException):
+            self.inventory.find('buildpacks', 'x')
+
+    def test_bound_apps(self):
+        self.inventory.sync(self.config)
+        apps = self.inventory.bound_apps('db')
+        self.assertEqual(sorted(a['name'] for a in apps), ['app1', 'app3'])
+        self.assertEqual(apps[0]['service_instance_guid'], 'si-1')
+        self.assertEqual(apps[0]['space_name'], 'dev')
+        self.assertEqual(self.inventory.bound_apps('missing'), [])
+
+
+class TokenManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        env = no_proxy_env()
+        env.start()
+        self.addCleanup(env.stop)
+        self.lifetime = 30
+        self.claims = {}
+
+        def uaa(handler):
+            claims = dict(self.claims, exp=int(time.time()) + self.lifetime)
+            payload = json.dumps(claims).encode('utf-8')
+            token = 'header.{}.signature'.format(
+                base64.urlsafe_b64encode(payload).decode().rstrip('='))
+            return 200, {'access_token': token, 'refresh_token': 'refresh'}
+
+        self.uaa = StandIn(uaa).__enter__()
+        self.addCleanup(self.uaa.__exit__)
+        self.config = cf_api.Config()
+        self.config.info = {'token_endpoint': self.uaa.url}
+        self.tokens = cf_api.TokenManager(self.config)
+        self.addCleanup(self.tokens.stop)
+
+    def test_short_lived_token(self):
+        self.tokens.access_token()
+        self.tokens.access_token()
+        time.sleep(0.5)
+        self.assertEqual(len(self.uaa.requests), 1)
+        # refreshed halfway through the 30s lifetime, not right away
+        self.assertAlmostEqual(self.tokens.margin, 15, delta=1)
+        self.assertIsNotNone(self.tokens.timer)
+
+    def test_issued_at(self):
+        self.claims['iat'] = int(time.time()) - 10
+        self.tokens.access_token()
+        self.assertAlmostEqual(self.tokens.margin, 20, delta=1)
+
+    def test_long_lived_token(self):
+        self.lifetime = 3600
+        self.tokens.access_token()
+        self.assertEqual(self.tokens.margin, self.tokens.refresh_margin)
+
+    def test_expired_token(self):
+        self.lifetime = 0
+        self.tokens.access_token()
+        self.assertIsNone(self.tokens.timer)
+        time.sleep(0.5)
+        self.assertEqual(len(self.uaa.requests), 1)
+
+
+
+class AsyncCloudControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        env = no_proxy_env()
+        env.start()
+        self.addCleanup(env.stop)
+        self.cc = FakeCloudController()
+        server = StandIn(self.cc).__enter__()
+        self.addCleanup(server.__exit__)
+        self.server = server
+        self.cc.url = server.url
+        self.config = cf_api.Config()
+        self.config.base_url = server.url
+        cf_api.configure(self.config)
+
+    def run_async(self, coroutine, concurrency=None):
+        async def run():
+            async with cf_api.AsyncCloudController(
+                    self.config, cf_api.V3Request, concurrency) as cc:
+                return await coroutine(cc)
+        return asyncio.run(run())
+
+    def test_pagination(self):
+        async def list_apps(cc):
+            return [r.guid async for r in cf_api.get_all_resources_async(
+                cc.request('/v3/apps'))]
+
+        self.assertEqual(self.run_async(list_apps),
+                         ['app-{}'.format(i) for i in range(5)])
+        # the token request and all three pages share one connection
+        self.assertEqual(self.server.connections, 2)
+
+    def test_fan_out(self):
+        async def env(cc):
+            apps = (await cc.request('/v3/apps', per_page=2).get()).resources
+            return [r.guid async for r in cf_api.fan_out(
+                cc, apps, '/v3/apps?names={name}')]
+
+        self.assertEqual(len(self.run_async(env)), 4)
+
+    def test_overlap(self):
+        # far more requests in flight than a thread pool would allow
+        slow = threading.Event()
+
+        def handler(handler):
+            slow.wait(0.5)
+            return 200, {'resources': [{'guid': handler.path}]}
+
+        with StandIn(handler) as server:
+            self.config.base_url = server.url
+
+            async def send_all(cc):
+                requests = [cc.request('/v3/apps/{}'.format(i)).get()
+                            for i in range(100)]
+                return await asyncio.gather(*requests)
+
+            start = time.monotonic()
+            responses = self.run_async(send_all, concurrency=100)
+            self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(len(responses), 100)
+        self.assertEqual(responses[7].resource.guid, '/v3/apps/7')
+
+    def test_https_proxy_tunnel(self):
+        pool = cf_api.AsyncConnectionPool(timeout=5)
+        with StandIn(lambda handler: (502, {})) as proxy:
+            with no_proxy_env(https_proxy=proxy.url):
+                with self.assertRaises(OSError):
+                    asyncio.run(pool.urlopen('GET',
+                                             'https://cf.invalid/v2/info'))
+            method, path, _, _ = proxy.requests[0]
+            self.assertEqual((method, path), ('CONNECT', 'cf.invalid:443'))
+
+    def test_error(self):
+        def not_found(handler):
+            return 404, {'errors': [{'title': 'CF-ResourceNotFound',
+                                     'detail': 'App not found'}]}
+
+        async def missing(cc):
+            return (await cc.request('/v3/apps/x').get()).resource
+
+        with StandIn(not_found) as server:
+            self.config.base_url = server.url
+            with self.assertRaises(cf_api.ResponseException) as e:
+                self.run_async(missing)
+        self.assertEqual(e.exception.response.status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 import os
+import re
+import csv
 import sys
+import json
 import time
 import shlex
+import shutil
 import signal
+import socket
+import struct
+import hashlib
+import threading
 import argparse
 import subprocess
 from urllib import parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 def main():
@@ -28,10 +37,11 @@ def main():
     )
     parser.add_argument(
         "--wait-seconds",
-        type=int,
-        default=4,
-        help="This indicates how long to wait for the SSH port forwarding to "
-        "connect.",
+        type=float,
+        default=15,
+        help="The deadline for the SSH port forward to start accepting "
+        "connections. The local port is polled until then, so the client "
+        "starts as soon as the tunnel is up.",
     )
     parser.add_argument(
         "--show-commands",
@@ -67,6 +77,34 @@ def main():
         default=None,
         help="Run this Redis command instead of an interactive session.",
     )
+    redis_args.add_argument(
+        "--pipe",
+        metavar="FILE",
+        help="Encode each line of FILE ('-' for stdin) as a Redis command and "
+        "send them all through 'redis-cli --pipe'",
+    )
+    redis_args.add_argument(
+        "--scan",
+        metavar="PATTERN",
+        help="Export keys matching PATTERN with their type and TTL as NDJSON, "
+        "using SCAN so the server is never blocked",
+    )
+    redis_args.add_argument(
+        "--scan-count",
+        type=int,
+        default=1000,
+        help="The SCAN COUNT hint, i.e. keys examined per round trip",
+    )
+    redis_args.add_argument(
+        "--scan-type",
+        help="Only export keys of this type, e.g. hash or zset",
+    )
+    redis_args.add_argument(
+        "--scan-sleep",
+        type=float,
+        default=0,
+        help="Seconds to sleep between SCAN batches to limit server load",
+    )
     psql_args = sps.add_parser("psql")
     psql_args.add_argument(
         "bastion_host",
@@ -130,6 +168,13 @@ def main():
         "--run-query",
         help="This indicates to use 'psql' to execute the given query and output the result as a CSV i.e. psql -c QUERY --csv",
     )
+    psql_args.add_argument(
+        "--query-file",
+        help="Run every ';'-terminated query in this file ('-' for stdin) over "
+        "one tunnel, --jobs at a time. A '-- name: NAME' line names the next "
+        "query. Results go to NAME.csv files in --output-dir, or to stdout as "
+        "NDJSON tagged with the query name.",
+    )
     psql_args.add_argument(
         "-t",
         "--include-tables",
@@ -142,6 +187,38 @@ def main():
         nargs="*",
         help="This indicates to specify for 'pg_dump' to exclude the given table names.",
     )
+    psql_args.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of parallel pg_dump/pg_restore connections. Used with "
+        "--output-dir and --restore.",
+    )
+    psql_args.add_argument(
+        "--output-dir",
+        help="Dump into this directory in parallel: --backup uses the "
+        "directory format with 'pg_dump -j'; otherwise each table from "
+        "--include-tables is dumped to its own file.",
+    )
+    psql_args.add_argument(
+        "--compress",
+        choices=sorted(compressors),
+        help="With --dump and --output-dir, stream pg_dump through this "
+        "compressor into size-bounded chunk files plus a manifest.json with "
+        "checksums and throughput, instead of a parallel dump.",
+    )
+    psql_args.add_argument(
+        "--chunk-size",
+        type=parse_size,
+        default="1G",
+        help="Maximum size of each compressed chunk, e.g. 512M or 2G",
+    )
+    psql_args.add_argument(
+        "--restore",
+        metavar="DIR",
+        help="Restore a dump directory written by --output-dir in parallel",
+    )
     psql_args.add_argument(
         "--use-history",
         action="store_true",
@@ -152,25 +229,203 @@ def main():
         action="store_true",
         help="This indicates to allow psql to use the built-in paging feature. Default dumps to stdout without paging. ",
     )
+    tunnel_args = sps.add_parser(
+        "tunnel",
+        help="Manage persistent SSH ControlMaster tunnels that later psql "
+        "and redis invocations attach to",
+    )
+    tunnel_args.add_argument("tunnel_action", choices=["start", "status", "stop"])
+    tunnel_args.add_argument(
+        "bastion_host",
+        nargs="?",
+        help="The bastion host. Required for 'start'; status and stop apply "
+        "to every tunnel when omitted.",
+    )
+    tunnel_args.add_argument(
+        "destination_urls",
+        nargs="*",
+        help="Server URLs to forward through the tunnel on 'start'",
+    )
+    tunnel_args.add_argument(
+        "--local-port",
+        type=int,
+        nargs="*",
+        dest="local_ports",
+        help="Local ports for each destination URL, in order. Free ports are "
+        "picked when omitted.",
+    )
+    fanout_args = sps.add_parser(
+        "fanout",
+        help="Run one query against many (bastion, URL) targets in parallel",
+    )
+    fanout_args.add_argument(
+        "targets",
+        help="File of targets, one 'NAME BASTION URL' or 'BASTION URL' per "
+        "line. postgres:// targets run the query with psql and redis:// "
+        "targets with redis-cli.",
+    )
+    fanout_args.add_argument(
+        "--query",
+        required=True,
+        help="The SQL query, or the Redis command, to run on every target",
+    )
+    fanout_args.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=8,
+        help="Number of targets to tunnel to and query at once",
+    )
+    fanout_args.add_argument(
+        "--psql-timeout",
+        type=int,
+        default=5,
+        help="Postgres PGCONNECT_TIMEOUT value to set in seconds",
+    )
+    bench_args = sps.add_parser(
+        "bench",
+        help="Measure tunnel latency and throughput to a Postgres or Redis "
+        "server, optionally against a direct connection",
+    )
+    bench_args.add_argument(
+        "bastion_host",
+        help="The bastion host. This can be a name in your ~/.ssh/config",
+    )
+    bench_args.add_argument(
+        "destination_url",
+        help="The postgres:// or redis:// server URL",
+    )
+    bench_args.add_argument(
+        "--samples",
+        type=int,
+        default=50,
+        help="Number of connect and round-trip samples per measurement",
+    )
+    bench_args.add_argument(
+        "--copy-rows",
+        type=int,
+        default=100000,
+        help="Rows of 1kB each to COPY out for the Postgres throughput test",
+    )
+    bench_args.add_argument(
+        "--direct",
+        action="store_true",
+        help="Also run the measurements directly against the server when "
+        "it is reachable without the bastion",
+    )
     args = parser.parse_args()
 
     def signal_handler(*args):
         signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+    if args.action is None:
+        parser.error("an action is required")
+    elif args.action == "tunnel":
+        return tunnel_command(args)
+    elif args.action == "fanout":
+        return fanout_command(args)
+    elif args.action == "bench":
+        return bench_command(args)
+    elif args.action == "psql" and args.compress:
+        if not (args.dump and args.output_dir) or args.query_file or args.restore:
+            parser.error("--compress requires --dump and --output-dir")
+
     signal_handler()
 
-    sshp = ssh_port_forward(
-        args.destination_url,
-        args.bastion_host,
-        args.local_port,
-        args.remote_port,
-        args.ssh_verbose,
-        args.ssh_config,
-        show_commands=args.show_commands,
-    )
-    if not args.show_commands:
-        time.sleep(args.wait_seconds)
-    if args.action == "psql":
+    forward = find_tunnel_forward(
+        args.bastion_host, args.destination_url, args.remote_port
+    )
+    if forward:
+        args.local_host = forward["local_host"]
+        args.local_port = forward["local_port"]
+        print(
+            f"using persistent tunnel {args.local_host}:{args.local_port}",
+            file=sys.stderr,
+        )
+        sshp = None
+    else:
+        sshp = ssh_port_forward(
+            args.destination_url,
+            args.bastion_host,
+            args.local_port,
+            args.remote_port,
+            args.ssh_verbose,
+            args.ssh_config,
+            show_commands=args.show_commands,
+        )
+    if sshp is not None and not args.show_commands:
+        try:
+            wait_for_tunnel(
+                args.local_host, args.local_port, sshp, args.wait_seconds
+            )
+        except TunnelError as e:
+            print(e, file=sys.stderr)
+            sshp.terminate()
+            sys.exit(1)
+    if args.action == "psql" and (
+        args.restore or args.query_file or args.dump and args.output_dir
+    ):
+        psql_url = local_psql_url(
+            args.destination_url, args.local_host, args.local_port, args.psql_password
+        )
+        psql_env = psql_environ(args.psql_timeout, args.use_history)
+        try:
+            if args.compress and args.dump:
+                command = pg_dump_command(
+                    psql_url,
+                    include_schema=args.include_schema,
+                    exclude_rows=args.exclude_rows,
+                    column_inserts=args.column_inserts,
+                    exclude_tables=args.exclude_tables,
+                    include_tables=args.include_tables,
+                    backup=args.backup,
+                )
+                failed = pg_dump_compressed(
+                    command,
+                    psql_env,
+                    args.output_dir,
+                    args.compress,
+                    args.chunk_size,
+                    extension=".dump" if args.backup else ".sql",
+                    show_commands=args.show_commands,
+                )
+            elif args.query_file:
+                if args.query_file == "-":
+                    queries = split_queries(sys.stdin)
+                else:
+                    with open(args.query_file) as f:
+                        queries = split_queries(f)
+                failed = run_queries(
+                    psql_url,
+                    queries,
+                    args.jobs,
+                    psql_env,
+                    output_dir=args.output_dir,
+                    show_commands=args.show_commands,
+                )
+            elif args.restore:
+                failed = pg_restore_parallel(
+                    psql_url, args.restore, args.jobs, psql_env, args.show_commands
+                )
+            else:
+                failed = pg_dump_parallel(
+                    psql_url,
+                    args.output_dir,
+                    args.jobs,
+                    psql_env,
+                    show_commands=args.show_commands,
+                    include_tables=args.include_tables,
+                    backup=args.backup,
+                    include_schema=args.include_schema,
+                    exclude_rows=args.exclude_rows,
+                    column_inserts=args.column_inserts,
+                    exclude_tables=args.exclude_tables,
+                )
+        finally:
+            if sshp is not None:
+                sshp.terminate()
+        sys.exit(1 if failed else 0)
+    elif args.action == "psql":
         p = psql_command(
             args.destination_url,
             args.local_host,
@@ -189,6 +444,26 @@ def main():
             use_pager=args.use_pager,
             run_query=args.run_query,
         )
+    elif args.action == "redis" and args.scan is not None:
+        if args.show_commands:
+            return
+        try:
+            redis_scan(
+                args.destination_url,
+                args.local_host,
+                args.local_port,
+                args.scan,
+                count=args.scan_count,
+                key_type=args.scan_type,
+                sleep=args.scan_sleep,
+            )
+        except (RedisError, OSError) as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        finally:
+            if sshp is not None:
+                sshp.terminate()
+        return
     elif args.action == "redis":
         p = redis_command(
             args.destination_url,
@@ -196,14 +471,16 @@ def main():
             args.local_port,
             run_query=args.run_query,
             show_commands=args.show_commands,
-    )
+            pipe=args.pipe,
+        )
     if args.show_commands:
         return
     try:
         if p.wait() != 0:
             print("psql error occurred", file=sys.stderr)
     finally:
-        sshp.terminate()
+        if sshp is not None:
+            sshp.terminate()
 
 
 def psql_command(
@@ -224,12 +501,41 @@ def psql_command(
     use_pager=False,
     run_query=None,
 ):
+    psql_url = local_psql_url(psql_url, local_host, local_port, psql_password)
+    if dump:
+        psql_command = pg_dump_command(
+            psql_url,
+            include_schema=include_schema,
+            exclude_rows=exclude_rows,
+            column_inserts=column_inserts,
+            exclude_tables=exclude_tables,
+            include_tables=include_tables,
+            backup=backup,
+        )
+    else:
+        psql_command = ["psql", psql_url]
+        if not use_pager:
+            psql_command.extend(["-P", "pager=off"])
+        if run_query:
+            psql_command.extend(["-c", run_query, "--csv"])
+    psql_env = psql_environ(psql_timeout, use_history)
+    if show_commands:
+        print_command(psql_command, psql_env)
+        return None
+    else:
+        print(psql_command, file=sys.stderr)
+    env = {name: value for name, value in os.environ.items()}
+    env.update(psql_env)
+    return subprocess.Popen(psql_command, env=env, stdin=sys.stdin)
+
+
+def local_psql_url(psql_url, local_host, local_port, psql_password=None):
     psql = parse.urlsplit(psql_url)
     if not psql_password:
         psql_password = psql.password
     else:
         psql_password = parse.quote(psql_password, safe="")
-    psql_url = parse.urlunsplit(
+    return parse.urlunsplit(
         (
             psql.scheme,
             f"{psql.username}:{psql_password}@{local_host}:{local_port}",
@@ -238,64 +544,474 @@ def psql_command(
             "",
         )
     )
-    if dump:
-        if include_schema:
-            psql_command = [
-                "pg_dump",
-                "--no-owner",
-                "--no-acl",
-                psql_url,
-            ]
-            if exclude_rows:
-                psql_command.append("--schema-only")
-        if not exclude_rows:
-            psql_command = [
-                "pg_dump",
-                "--no-owner",
-                "--no-acl",
-                psql_url,
-            ]
-            if not include_schema:
-                psql_command.append("--data-only")
-            if backup:
-                psql_command.insert(1, "-Fc")
-            elif column_inserts:
-                psql_command.insert(1, "--column-inserts")
-            else:
-                psql_command.insert(1, "--on-conflict-do-nothing")
-                psql_command.insert(1, "--inserts")
-            if exclude_tables or include_tables:
-                tables_flags = []
-                if exclude_tables:
-                    for table_name in exclude_tables:
-                        tables_flags += ["-T", table_name]
-                if include_tables:
-                    for table_name in include_tables:
-                        tables_flags += ["-t", table_name]
-                psql_command = psql_command[0:1] + tables_flags + psql_command[1:]
-            # print(psql_command, file=sys.stderr)
-    else:
-        psql_command = ["psql", psql_url]
-        if not use_pager:
-            psql_command.extend(["-P", "pager=off"])
-        if run_query:
-            psql_command.extend(["-c", run_query, "--csv"])
+
+
+def psql_environ(psql_timeout=None, use_history=False):
     psql_env = {}
     if psql_timeout:
         psql_env["PGCONNECT_TIMEOUT"] = str(psql_timeout)
     if not use_history:
         psql_env["PSQL_HISTORY"] = os.devnull
+    return psql_env
+
+
+def print_command(command, command_env):
+    line = ["env"]
+    line.extend([name + "=" + shlex.quote(value) for name, value in command_env.items()])
+    line.extend([shlex.quote(value) for value in command])
+    print(" ".join(line))
+
+
+def pg_dump_command(
+    psql_url,
+    include_schema=False,
+    exclude_rows=False,
+    column_inserts=False,
+    exclude_tables=None,
+    include_tables=None,
+    backup=False,
+    backup_format="-Fc",
+):
+    if include_schema:
+        psql_command = [
+            "pg_dump",
+            "--no-owner",
+            "--no-acl",
+            psql_url,
+        ]
+        if exclude_rows:
+            psql_command.append("--schema-only")
+    if not exclude_rows:
+        psql_command = [
+            "pg_dump",
+            "--no-owner",
+            "--no-acl",
+            psql_url,
+        ]
+        if not include_schema:
+            psql_command.append("--data-only")
+        if backup:
+            psql_command.insert(1, backup_format)
+        elif column_inserts:
+            psql_command.insert(1, "--column-inserts")
+        else:
+            psql_command.insert(1, "--on-conflict-do-nothing")
+            psql_command.insert(1, "--inserts")
+        if exclude_tables or include_tables:
+            tables_flags = []
+            if exclude_tables:
+                for table_name in exclude_tables:
+                    tables_flags += ["-T", table_name]
+            if include_tables:
+                for table_name in include_tables:
+                    tables_flags += ["-t", table_name]
+            psql_command = psql_command[0:1] + tables_flags + psql_command[1:]
+    return psql_command
+
+
+def pg_dump_parallel(
+    psql_url,
+    output_dir,
+    jobs,
+    psql_env,
+    show_commands=False,
+    include_tables=None,
+    backup=False,
+    **dump_flags,
+):
+    """Dump into output_dir using several connections over the tunnel.
+
+    With --backup this is a single 'pg_dump -Fd -j JOBS'; otherwise each
+    table from --include-tables is dumped by its own pg_dump, JOBS at a time.
+    Returns the number of failed dumps.
+    """
+    env = dict(os.environ, **psql_env)
+    if backup:
+        command = pg_dump_command(
+            psql_url,
+            include_tables=include_tables,
+            backup=True,
+            backup_format="-Fd",
+            **dump_flags,
+        )
+        # the schema-only form of pg_dump_command has no format flag, and
+        # -j only works with the directory format
+        command = [c for c in command if c != "-Fd"]
+        command[1:1] = ["-Fd", "-j", str(jobs), "-f", output_dir, "--verbose"]
+        if show_commands:
+            print_command(command, psql_env)
+            return 0
+        print(command, file=sys.stderr)
+        p = subprocess.Popen(command, env=env, stderr=subprocess.PIPE, text=True)
+        done = 0
+        start = time.monotonic()
+        for line in p.stderr:
+            table = re.search(r'dumping contents of table "?([^"]+)"?', line)
+            if table:
+                done += 1
+                elapsed = time.monotonic() - start
+                print(f"[{done}] {table.group(1)} {elapsed:.1f}s", file=sys.stderr)
+            elif "error" in line.lower() or "warning" in line.lower():
+                sys.stderr.write(line)
+        return 1 if p.wait() != 0 else 0
+    if not include_tables:
+        print(
+            "parallel dumps need --backup or --include-tables",
+            file=sys.stderr,
+        )
+        return 1
+    commands = []
+    for table_name in include_tables:
+        command = pg_dump_command(psql_url, include_tables=[table_name], **dump_flags)
+        fn = re.sub(r"[^\w.-]", "_", table_name) + ".sql"
+        command.extend(["-f", os.path.join(output_dir, fn)])
+        commands.append((table_name, command))
     if show_commands:
-        command = ["env"]
-        command.extend([name+"="+shlex.quote(value) for name, value in psql_env.items()])
-        command.extend([shlex.quote(value) for value in psql_command])
-        print(" ".join(command))
-        return None
-    else:
-        print(psql_command, file=sys.stderr)
-    env = {name: value for name, value in os.environ.items()}
-    env.update(psql_env)
-    return subprocess.Popen(psql_command, env=env, stdin=sys.stdin)
+        for table_name, command in commands:
+            print_command(command, psql_env)
+        return 0
+    os.makedirs(output_dir, exist_ok=True)
+    return run_parallel(commands, jobs, env)
+
+
+def run_parallel(commands, jobs, env):
+    """Run (name, command) pairs with up to jobs at once, reporting each."""
+    done = 0
+    failed = 0
+
+    def run(item):
+        name, command = item
+        start = time.monotonic()
+        p = subprocess.run(command, env=env, stderr=subprocess.PIPE, text=True)
+        return name, command, p, time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run, item) for item in commands]
+        for future in as_completed(futures):
+            name, command, p, elapsed = future.result()
+            done += 1
+            output = command[command.index("-f") + 1] if "-f" in command else ""
+            size = os.path.getsize(output) if os.path.isfile(output) else 0
+            status = "ok" if p.returncode == 0 else f"failed ({p.returncode})"
+            print(
+                f"[{done}/{len(commands)}] {name} {status} {size} bytes {elapsed:.1f}s",
+                file=sys.stderr,
+            )
+            if p.returncode != 0:
+                failed += 1
+                sys.stderr.write(p.stderr)
+    return failed
+
+
+def scan_quotes(line, quote=None):
+    """Return (quote left open at the end of line, start of a -- comment).
+
+    quote is the one open at its start: None, a quote character or a
+    dollar-quote tag such as $$ or $body$. The comment start is None when
+    line has no -- comment outside of quotes.
+    """
+    i = 0
+    while i < len(line):
+        if quote:
+            end = line.find(quote, i)
+            if end < 0:
+                return quote, None
+            i = end + len(quote)
+            quote = None
+            continue
+        if line.startswith("--", i):
+            return None, i
+        if line[i] in "'\"":
+            quote = line[i]
+            i += 1
+            continue
+        dollar = re.match(r"\$(?:[A-Za-z_]\w*)?\$", line[i:])
+        if dollar:
+            quote = dollar.group(0)
+            i += len(quote)
+            continue
+        i += 1
+    return quote, None
+
+
+def split_queries(lines):
+    """Return (name, query) pairs for each ';'-terminated query.
+
+    A query ends at a line ending in ';', ignoring a trailing -- comment,
+    outside of any string, quoted identifier or dollar-quoted body. Names
+    from '-- name:' comments are made safe to use as file names.
+    """
+    queries = []
+    name = None
+    query = []
+    quote = None
+    for line in lines:
+        stripped = line.strip()
+        match = re.match(r"^--\s*name:\s*(\S+)", stripped)
+        if match and not query:
+            name = re.sub(r"[^\w.-]", "_", match.group(1))
+            continue
+        if not query and (not stripped or stripped.startswith("--")):
+            continue
+        query.append(line.rstrip("\n"))
+        quote, comment = scan_quotes(line, quote)
+        if quote is None and line[:comment].rstrip().endswith(";"):
+            queries.append((name or f"q{len(queries) + 1:04d}", "\n".join(query)))
+            name = None
+            query = []
+    if query:
+        queries.append((name or f"q{len(queries) + 1:04d}", "\n".join(query)))
+    return queries
+
+
+def run_queries(psql_url, queries, jobs, psql_env, output_dir=None, show_commands=False):
+    """Run queries jobs at a time, each in its own psql over the tunnel.
+
+    Each result set is written to output_dir/NAME.csv, or, without an
+    output_dir, streamed to stdout as {"query": NAME, "row": {...}} lines.
+    Returns the number of failed queries.
+    """
+    names = [name for name, query in queries]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        print(f"duplicate query names: {' '.join(duplicates)}", file=sys.stderr)
+        return len(duplicates)
+    commands = [
+        (name, ["psql", psql_url, "-X", "-v", "ON_ERROR_STOP=1", "--csv", "-c", query])
+        for name, query in queries
+    ]
+    if show_commands:
+        for name, command in commands:
+            print_command(command, psql_env)
+        return 0
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    env = dict(os.environ, **psql_env)
+    lock = threading.Lock()
+
+    def run(item):
+        name, command = item
+        start = time.monotonic()
+        rows = 0
+        if output_dir:
+            with open(os.path.join(output_dir, f"{name}.csv"), "w") as out:
+                p = subprocess.Popen(
+                    command, env=env, stdin=subprocess.DEVNULL, stdout=out,
+                    stderr=subprocess.PIPE, text=True,
+                )
+                _, err = p.communicate()
+        else:
+            p = subprocess.Popen(
+                command, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, text=True,
+            )
+            for row in csv.DictReader(p.stdout):
+                rows += 1
+                line = json.dumps({"query": name, "row": row})
+                with lock:
+                    sys.stdout.write(line + "\n")
+            err = p.stderr.read()
+            p.wait()
+        return name, p.returncode, err, rows, time.monotonic() - start
+
+    failed = 0
+    done = 0
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run, item) for item in commands]
+        for future in as_completed(futures):
+            name, code, err, rows, elapsed = future.result()
+            done += 1
+            status = "ok" if code == 0 else f"failed ({code})"
+            if not output_dir:
+                status += f" {rows} rows"
+            with lock:
+                sys.stdout.flush()
+                print(f"[{done}/{len(commands)}] {name} {status} {elapsed:.3f}s", file=sys.stderr)
+                if code != 0:
+                    failed += 1
+                    sys.stderr.write(err)
+    return failed
+
+
+compressors = {
+    # name: (extension, command, multithreaded alternative, decompress)
+    "gzip": (".gz", ["gzip", "-c"], ["pigz", "-c"], "gzip -dc"),
+    "zstd": (".zst", ["zstd", "-q", "-c"], ["zstd", "-q", "-c", "-T0"], "zstd -dc"),
+    "xz": (".xz", ["xz", "-c"], ["xz", "-c", "-T0"], "xz -dc"),
+}
+
+
+def parse_size(value):
+    units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    match = re.match(r"^(\d+)([KMGT]?)B?$", value.strip().upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size: {value}")
+    return int(match.group(1)) * units[match.group(2)]
+
+
+def compressor_command(name):
+    extension, command, threaded, decompress = compressors[name]
+    if shutil.which(threaded[0]):
+        command = threaded
+    return extension, command, decompress
+
+
+def pg_dump_compressed(
+    command,
+    psql_env,
+    output_dir,
+    compress,
+    chunk_size,
+    extension=".sql",
+    show_commands=False,
+    block_size=1 << 20,
+):
+    """Stream pg_dump through a compressor into chunk files.
+
+    The uncompressed dump never touches the disk. Chunks are named
+    dump.sql.gz.0000 and so on, and 'cat' of all chunks in order is the
+    compressed stream. manifest.json records each chunk's size and sha256
+    along with overall throughput. Returns 1 if any stage failed.
+    """
+    suffix, compress_command, decompress = compressor_command(compress)
+    if show_commands:
+        print_command(command, psql_env)
+        print(" ".join(compress_command))
+        return 0
+    for program in [command[0], compress_command[0]]:
+        if not shutil.which(program):
+            print(f"{program} not found", file=sys.stderr)
+            return 1
+    print(command, compress_command, file=sys.stderr)
+    os.makedirs(output_dir, exist_ok=True)
+    env = dict(os.environ, **psql_env)
+    start = time.monotonic()
+    compressor = subprocess.Popen(
+        compress_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    )
+    dump = subprocess.Popen(command, env=env, stdout=subprocess.PIPE)
+    raw_bytes = [0]
+    relay_failed = [False]
+
+    def relay():
+        # counts the uncompressed bytes on their way to the compressor
+        try:
+            for block in iter(lambda: dump.stdout.read(block_size), b""):
+                raw_bytes[0] += len(block)
+                compressor.stdin.write(block)
+        except BrokenPipeError:
+            # the compressor exited early, pg_dump would block on a full pipe
+            relay_failed[0] = True
+            dump.stdout.close()
+            dump.terminate()
+        finally:
+            try:
+                compressor.stdin.close()
+            except BrokenPipeError:
+                relay_failed[0] = True
+
+    relay_thread = threading.Thread(target=relay, daemon=True)
+    relay_thread.start()
+    basename = "dump" + extension + suffix
+    chunks = []
+    chunk = None
+    for block in iter(lambda: compressor.stdout.read(block_size), b""):
+        while block:
+            if chunk is None or chunk["bytes"] >= chunk_size:
+                if chunk is not None:
+                    chunk["file"].close()
+                fn = f"{basename}.{len(chunks):04d}"
+                chunk = {
+                    "name": fn,
+                    "bytes": 0,
+                    "sha256": hashlib.sha256(),
+                    "file": open(os.path.join(output_dir, fn), "wb"),
+                }
+                chunks.append(chunk)
+            part = block[: chunk_size - chunk["bytes"]]
+            block = block[len(part):]
+            chunk["file"].write(part)
+            chunk["sha256"].update(part)
+            chunk["bytes"] += len(part)
+    if chunk is not None:
+        chunk["file"].close()
+    relay_thread.join()
+    dump_code = dump.wait()
+    compress_code = compressor.wait()
+    seconds = time.monotonic() - start
+    compressed_bytes = sum(c["bytes"] for c in chunks)
+    manifest = {
+        "compressor": compress_command,
+        "chunk_size": chunk_size,
+        "chunks": [
+            {"name": c["name"], "bytes": c["bytes"], "sha256": c["sha256"].hexdigest()}
+            for c in chunks
+        ],
+        "raw_bytes": raw_bytes[0],
+        "compressed_bytes": compressed_bytes,
+        "ratio": round(raw_bytes[0] / compressed_bytes, 2) if compressed_bytes else None,
+        "seconds": round(seconds, 3),
+        "raw_mb_per_s": round(raw_bytes[0] / seconds / 1e6, 2) if seconds else None,
+        "pg_dump_status": dump_code,
+        "compressor_status": compress_code,
+        "complete": not (dump_code or compress_code or relay_failed[0]),
+        "restore": f"cat {basename}.* | {decompress}",
+    }
+    with open(os.path.join(output_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(
+        f"{len(chunks)} chunks, {raw_bytes[0]} bytes -> {compressed_bytes} bytes "
+        f"in {seconds:.1f}s",
+        file=sys.stderr,
+    )
+    if relay_failed[0]:
+        print(
+            f"{compress_command[0]} exited before pg_dump finished, "
+            "the dump is incomplete",
+            file=sys.stderr,
+        )
+    return 1 if dump_code or compress_code or relay_failed[0] else 0
+
+
+def pg_restore_parallel(psql_url, input_dir, jobs, psql_env, show_commands=False):
+    """Restore a directory dump made by pg_dump_parallel.
+
+    Directory format archives go through 'pg_restore -j JOBS'; a directory
+    of per-table .sql files is loaded with one psql per file, JOBS at a time.
+    """
+    if not os.path.isdir(input_dir):
+        print(f"{input_dir} is not a directory", file=sys.stderr)
+        return 1
+    env = dict(os.environ, **psql_env)
+    if os.path.exists(os.path.join(input_dir, "toc.dat")):
+        command = [
+            "pg_restore",
+            "--no-owner",
+            "--no-acl",
+            "-j",
+            str(jobs),
+            "-d",
+            psql_url,
+            input_dir,
+        ]
+        if show_commands:
+            print_command(command, psql_env)
+            return 0
+        print(command, file=sys.stderr)
+        return 1 if subprocess.run(command, env=env).returncode != 0 else 0
+    commands = [
+        (
+            fn,
+            ["psql", psql_url, "-v", "ON_ERROR_STOP=1", "-q", "-f", os.path.join(input_dir, fn)],
+        )
+        for fn in sorted(os.listdir(input_dir))
+        if fn.endswith(".sql")
+    ]
+    if show_commands:
+        for fn, command in commands:
+            print_command(command, psql_env)
+        return 0
+    return run_parallel(commands, jobs, env)
 
 
 def redis_command(
@@ -304,6 +1020,7 @@ def redis_command(
     local_port,
     show_commands=False,
     run_query=None,
+    pipe=None,
 ):
     redis = parse.urlsplit(redis_url)
     redis_cli = [
@@ -313,18 +1030,196 @@ def redis_command(
         "-p",
         str(local_port),
     ]
-    if run_query is not None:
+    if pipe is not None:
+        redis_cli.append("--pipe")
+    elif run_query is not None:
         redis_cli.extend(run_query)
-    redis_env = {"REDISCLI_AUTH": redis.password}
+    redis_env = {"REDISCLI_AUTH": redis.password or ""}
     if show_commands:
         command = ["env"]
         command.extend([name+"="+shlex.quote(value) for name, value in redis_env.items()])
         command.extend([shlex.quote(value) for value in redis_cli])
+        if pipe is not None:
+            # --pipe wants RESP, which psqlssh encodes from the plain commands
+            print(f"# RESP-encoded commands from {pipe} are written to the stdin of:")
         print(" ".join(command))
         return None
     else:
         print(redis_cli, file=sys.stderr)
-    return subprocess.Popen(redis_cli, env=redis_env)
+    env = {name: value for name, value in os.environ.items()}
+    env.update(redis_env)
+    if pipe is None:
+        return subprocess.Popen(redis_cli, env=env)
+    p = subprocess.Popen(redis_cli, env=env, stdin=subprocess.PIPE)
+    f = sys.stdin if pipe == "-" else open(pipe)
+    try:
+        for line in f:
+            args = shlex.split(line, comments=True)
+            if args:
+                p.stdin.write(resp_encode(args))
+    finally:
+        p.stdin.close()
+        if f is not sys.stdin:
+            f.close()
+    return p
+
+
+class RedisError(Exception):
+    pass
+
+
+def resp_encode(args):
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(out)
+
+
+class RedisConnection(object):
+    """Minimal RESP client for pipelined requests over the tunnel."""
+
+    def __init__(self, host, port, username=None, password=None, timeout=30):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.file = self.sock.makefile("rb")
+        if password:
+            self.call(*(["AUTH", username, password] if username else ["AUTH", password]))
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def read(self):
+        line = self.file.readline()
+        if not line:
+            raise RedisError("connection closed by server")
+        kind, value = line[:1], line[1:-2]
+        if kind == b"+":
+            return value.decode("utf-8")
+        elif kind == b"-":
+            return RedisError(value.decode("utf-8"))
+        elif kind == b":":
+            return int(value)
+        elif kind == b"$":
+            if int(value) < 0:
+                return None
+            data = self.file.read(int(value) + 2)
+            return data[:-2]
+        elif kind == b"*":
+            if int(value) < 0:
+                return None
+            return [self.read() for _ in range(int(value))]
+        raise RedisError(f"unexpected reply: {line!r}")
+
+    def pipeline(self, commands):
+        """Send all commands in one write, then read every reply."""
+        self.sock.sendall(b"".join(resp_encode(c) for c in commands))
+        return [self.read() for _ in commands]
+
+    def call(self, *args):
+        reply = self.pipeline([args])[0]
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+
+def redis_scan(
+    redis_url,
+    local_host,
+    local_port,
+    pattern,
+    count=1000,
+    key_type=None,
+    sleep=0,
+    out=sys.stdout,
+):
+    """Write {"key", "type", "ttl_ms"} lines for keys matching pattern.
+
+    Each SCAN batch is followed by one pipelined round trip of TYPE and
+    PTTL for its keys. A ttl_ms of -1 means no expiry and -2 means the key
+    disappeared during the scan.
+    """
+    redis = parse.urlsplit(redis_url)
+    conn = RedisConnection(
+        local_host,
+        local_port,
+        username=parse.unquote(redis.username) if redis.username else None,
+        password=parse.unquote(redis.password) if redis.password else None,
+    )
+    scan = ["SCAN", None, "MATCH", pattern, "COUNT", count]
+    if key_type:
+        scan.extend(["TYPE", key_type])
+    cursor = b"0"
+    total = 0
+    try:
+        while True:
+            scan[1] = cursor
+            cursor, keys = conn.call(*scan)
+            if keys:
+                replies = conn.pipeline(
+                    [c for key in keys for c in (["TYPE", key], ["PTTL", key])]
+                )
+                for i, key in enumerate(keys):
+                    type_, ttl = replies[2 * i : 2 * i + 2]
+                    record = {
+                        "key": key.decode("utf-8", "backslashreplace"),
+                        "type": type_ if isinstance(type_, str) else None,
+                        "ttl_ms": ttl if isinstance(ttl, int) else None,
+                    }
+                    out.write(json.dumps(record) + "\n")
+                total += len(keys)
+                out.flush()
+            if cursor == b"0":
+                break
+            if sleep:
+                time.sleep(sleep)
+    finally:
+        conn.close()
+    print(f"{total} keys", file=sys.stderr)
+    return total
+
+
+class TunnelError(Exception):
+    pass
+
+
+def wait_for_tunnel(
+    local_host,
+    local_port,
+    sshp,
+    deadline,
+    initial_delay=0.05,
+    max_delay=1.0,
+):
+    """Poll the forwarded port until it accepts a TCP connection.
+
+    Raises TunnelError when the ssh process exits first or the deadline
+    passes. Returns the number of seconds it took.
+    """
+    start = time.monotonic()
+    delay = initial_delay
+    while True:
+        code = sshp.poll()
+        if code is not None:
+            raise TunnelError(f"ssh port forward exited with status {code}")
+        elapsed = time.monotonic() - start
+        remaining = deadline - elapsed
+        try:
+            with socket.create_connection(
+                (local_host, local_port), timeout=max(min(remaining, 1.0), 0.01)
+            ):
+                return elapsed
+        except OSError:
+            pass
+        remaining = deadline - (time.monotonic() - start)
+        if remaining <= 0:
+            raise TunnelError(
+                f"ssh port forward to {local_host}:{local_port} was not ready "
+                f"after {deadline} seconds"
+            )
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
 
 
 def ssh_port_forward(
@@ -343,6 +1238,7 @@ def ssh_port_forward(
         "ssh",
         "-NL",
         f"{local_port}:{remote_host}:{remote_port}",
+        "-oExitOnForwardFailure=yes",
         bastion_host,
     ]
     if ssh_verbose:
@@ -359,5 +1255,533 @@ def ssh_port_forward(
     return subprocess.Popen(ssh_port_forward)
 
 
+default_remote_ports = {"postgres": 5432, "postgresql": 5432, "redis": 6379}
+state_dir = os.path.expanduser(os.getenv("PSQLSSH_STATE_DIR", "~/.cache/psqlssh"))
+
+
+def free_local_port(local_host):
+    with socket.socket() as s:
+        s.bind((local_host, 0))
+        return s.getsockname()[1]
+
+
+def load_tunnels():
+    try:
+        with open(os.path.join(state_dir, "tunnels.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_tunnels(tunnels):
+    os.makedirs(state_dir, mode=0o700, exist_ok=True)
+    path = os.path.join(state_dir, "tunnels.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(tunnels, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def control_path(bastion_host):
+    return os.path.join(state_dir, f"{bastion_host}.sock")
+
+
+def ssh_control(bastion_host, operation, ssh_config=None, forward=None):
+    command = ["ssh", "-S", control_path(bastion_host), "-O", operation]
+    if forward:
+        command.extend(["-L", forward])
+    if ssh_config:
+        command.insert(1, "-F" + ssh_config)
+    command.append(bastion_host)
+    return command
+
+
+def tunnel_alive(bastion_host, ssh_config=None):
+    return (
+        subprocess.run(
+            ssh_control(bastion_host, "check", ssh_config),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ).returncode
+        == 0
+    )
+
+
+def find_tunnel_forward(bastion_host, destination_url, remote_port):
+    """Return the persistent forward to destination_url, if one is up."""
+    tunnel = load_tunnels().get(bastion_host)
+    if not tunnel:
+        return None
+    url = parse.urlsplit(destination_url)
+    remote_port = url.port or remote_port
+    for forward in tunnel["forwards"]:
+        if (
+            forward["remote_host"] == url.hostname
+            and forward["remote_port"] == remote_port
+        ):
+            if tunnel_alive(bastion_host):
+                return forward
+            return None
+    return None
+
+
+def tunnel_start(
+    bastion_host,
+    destination_urls,
+    local_ports=None,
+    local_host="localhost",
+    ssh_verbose=False,
+    ssh_config=None,
+    show_commands=False,
+):
+    tunnels = load_tunnels()
+    tunnel = tunnels.setdefault(
+        bastion_host, {"control_path": control_path(bastion_host), "forwards": []}
+    )
+    commands = []
+    if show_commands or not tunnel_alive(bastion_host, ssh_config):
+        tunnel["forwards"] = []
+        master = [
+            "ssh",
+            "-fNM",
+            "-S",
+            control_path(bastion_host),
+            "-oControlPersist=yes",
+            "-oExitOnForwardFailure=yes",
+            "-v" if ssh_verbose else "-q",
+            bastion_host,
+        ]
+        if ssh_config:
+            master.insert(1, "-F" + ssh_config)
+        commands.append(master)
+    local_ports = list(local_ports or [])
+    for destination_url in destination_urls:
+        url = parse.urlsplit(destination_url)
+        remote_port = url.port or default_remote_ports.get(url.scheme)
+        if remote_port is None:
+            raise TunnelError(f"no port in {destination_url}")
+        if any(
+            f["remote_host"] == url.hostname and f["remote_port"] == remote_port
+            for f in tunnel["forwards"]
+        ):
+            continue
+        local_port = local_ports.pop(0) if local_ports else free_local_port(local_host)
+        forward = f"{local_host}:{local_port}:{url.hostname}:{remote_port}"
+        commands.append(ssh_control(bastion_host, "forward", ssh_config, forward))
+        tunnel["forwards"].append(
+            {
+                "local_host": local_host,
+                "local_port": local_port,
+                "remote_host": url.hostname,
+                "remote_port": remote_port,
+            }
+        )
+    if show_commands:
+        for command in commands:
+            print(" ".join(shlex.quote(c) for c in command))
+        return
+    os.makedirs(state_dir, mode=0o700, exist_ok=True)
+    for command in commands:
+        print(command, file=sys.stderr)
+        if subprocess.run(command).returncode != 0:
+            raise TunnelError(f"command failed: {' '.join(command)}")
+    save_tunnels(tunnels)
+
+
+def tunnel_status(bastion_host=None, ssh_config=None):
+    tunnels = load_tunnels()
+    for name, tunnel in tunnels.items():
+        if bastion_host and name != bastion_host:
+            continue
+        state = "up" if tunnel_alive(name, ssh_config) else "down"
+        print(f"{name} {state} {tunnel['control_path']}")
+        for f in tunnel["forwards"]:
+            print(
+                f"  {f['local_host']}:{f['local_port']} -> "
+                f"{f['remote_host']}:{f['remote_port']}"
+            )
+
+
+def tunnel_stop(bastion_host=None, ssh_config=None):
+    tunnels = load_tunnels()
+    for name in list(tunnels):
+        if bastion_host and name != bastion_host:
+            continue
+        if tunnel_alive(name, ssh_config):
+            subprocess.run(ssh_control(name, "exit", ssh_config))
+        del tunnels[name]
+    save_tunnels(tunnels)
+
+
+allocated_ports = set()
+allocated_ports_lock = threading.Lock()
+
+
+def allocate_local_port(local_host):
+    # free_local_port may hand out the same port twice before ssh binds it
+    with allocated_ports_lock:
+        while True:
+            port = free_local_port(local_host)
+            if port not in allocated_ports:
+                allocated_ports.add(port)
+                return port
+
+
+def read_targets(fn):
+    targets = []
+    with open(fn) as f:
+        for line in f:
+            parts = line.split("#", 1)[0].split()
+            if not parts:
+                continue
+            elif len(parts) == 2:
+                url = parse.urlsplit(parts[1])
+                parts.insert(0, f"{parts[0]}/{url.hostname}")
+            elif len(parts) != 3:
+                raise ValueError(f"invalid target line: {line.strip()}")
+            targets.append(dict(zip(["name", "bastion_host", "destination_url"], parts)))
+    return targets
+
+
+def query_target(
+    target,
+    query,
+    local_host="localhost",
+    ssh_verbose=False,
+    ssh_config=None,
+    wait_seconds=15,
+    psql_timeout=5,
+):
+    """Tunnel to one target and run query there.
+
+    Returns (columns, rows, error) where error is None on success.
+    """
+    url = parse.urlsplit(target["destination_url"])
+    local_port = allocate_local_port(local_host)
+    remote_port = default_remote_ports.get(url.scheme)
+    sshp = None
+    try:
+        sshp = ssh_port_forward(
+            target["destination_url"],
+            target["bastion_host"],
+            local_port,
+            remote_port,
+            ssh_verbose,
+            ssh_config,
+        )
+        wait_for_tunnel(local_host, local_port, sshp, wait_seconds)
+        if url.scheme == "redis":
+            command = ["redis-cli", "-h", local_host, "-p", str(local_port)]
+            command.extend(shlex.split(query))
+            env = dict(os.environ, REDISCLI_AUTH=url.password or "")
+        else:
+            psql_url = local_psql_url(target["destination_url"], local_host, local_port)
+            command = ["psql", psql_url, "-X", "-v", "ON_ERROR_STOP=1", "--csv", "-c", query]
+            env = dict(os.environ, **psql_environ(psql_timeout))
+        p = subprocess.run(
+            command, env=env, stdin=subprocess.DEVNULL, capture_output=True, text=True
+        )
+        if p.returncode != 0:
+            return None, [], p.stderr.strip() or f"exit status {p.returncode}"
+        if url.scheme == "redis":
+            return ["output"], [[line] for line in p.stdout.splitlines()], None
+        rows = list(csv.reader(p.stdout.splitlines()))
+        return (rows[0] if rows else []), rows[1:], None
+    except (TunnelError, OSError) as e:
+        return None, [], str(e)
+    finally:
+        if sshp is not None:
+            sshp.terminate()
+            sshp.wait()
+        with allocated_ports_lock:
+            allocated_ports.discard(local_port)
+
+
+def fanout_command(args):
+    try:
+        targets = read_targets(args.targets)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if args.show_commands:
+        for target in targets:
+            print(f"{target['name']}: {target['bastion_host']} {target['destination_url']}")
+        return
+    out = csv.writer(sys.stdout)
+    header = None
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {
+            pool.submit(
+                query_target,
+                target,
+                args.query,
+                local_host=args.local_host,
+                ssh_verbose=args.ssh_verbose,
+                ssh_config=args.ssh_config,
+                wait_seconds=args.wait_seconds,
+                psql_timeout=args.psql_timeout,
+            ): target
+            for target in targets
+        }
+        try:
+            for future in as_completed(futures):
+                target = futures[future]
+                columns, rows, error = future.result()
+                if error is not None:
+                    failed.append(target["name"])
+                    print(f"{target['name']}: failed: {error}", file=sys.stderr)
+                    continue
+                if columns != header:
+                    header = columns
+                    out.writerow(["target"] + columns)
+                for row in rows:
+                    out.writerow([target["name"]] + row)
+                sys.stdout.flush()
+                print(f"{target['name']}: ok {len(rows)} rows", file=sys.stderr)
+        except KeyboardInterrupt:
+            # the running ssh and psql got the SIGINT too, only wait for
+            # their tunnels to close and never start the queued targets
+            print("interrupted, cancelling queued targets", file=sys.stderr)
+            pool.shutdown(wait=False, cancel_futures=True)
+            sys.exit(130)
+    print(
+        f"{len(targets) - len(failed)}/{len(targets)} targets succeeded",
+        file=sys.stderr,
+    )
+    if failed:
+        sys.exit(1)
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        "p50": values[int(0.50 * (len(values) - 1))],
+        "p95": values[int(0.95 * (len(values) - 1))],
+        "p99": values[int(0.99 * (len(values) - 1))],
+        "max": values[-1],
+    }
+
+
+def bench_tcp_connect(host, port, samples):
+    times = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        with socket.create_connection((host, port), timeout=10):
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_pg_ping(host, port, samples):
+    """Time connect plus an SSLRequest round trip to the Postgres server.
+
+    Unlike a bare connect, which ssh accepts locally, the SSLRequest reply
+    comes from the server itself, so this is the latency through the hop.
+    """
+    times = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        with socket.create_connection((host, port), timeout=10) as sock:
+            sock.sendall(struct.pack("!ii", 8, 80877103))
+            if not sock.recv(1):
+                raise OSError("connection closed before the SSLRequest reply")
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_psql_connect(psql_url, env, samples):
+    times = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        p = subprocess.run(
+            ["psql", psql_url, "-X", "-At", "-c", "select 1"],
+            env=env, stdin=subprocess.DEVNULL, capture_output=True, text=True,
+        )
+        if p.returncode != 0:
+            raise OSError(p.stderr.strip())
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_psql_queries(psql_url, env, samples):
+    script = "\\timing on\n" + "select 1;\n" * samples
+    p = subprocess.run(
+        ["psql", psql_url, "-X", "-At"],
+        env=env, input=script, capture_output=True, text=True,
+    )
+    if p.returncode != 0:
+        raise OSError(p.stderr.strip())
+    return [
+        float(ms) / 1000
+        for ms in re.findall(r"^Time: ([\d.]+) ms", p.stdout, re.MULTILINE)
+    ]
+
+
+def bench_copy_out(psql_url, env, rows, block_size=1 << 20):
+    query = (
+        "COPY (SELECT repeat('x', 1000) FROM generate_series(1, "
+        f"{int(rows)})) TO STDOUT"
+    )
+    start = time.perf_counter()
+    p = subprocess.Popen(
+        ["psql", psql_url, "-X", "-c", query],
+        env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+    )
+    total = sum(len(b) for b in iter(lambda: p.stdout.read(block_size), b""))
+    if p.wait() != 0:
+        raise OSError(f"COPY failed with status {p.returncode}")
+    return total, time.perf_counter() - start
+
+
+def bench_redis_ping(host, port, redis_url, samples):
+    redis = parse.urlsplit(redis_url)
+    conn = RedisConnection(
+        host,
+        port,
+        username=parse.unquote(redis.username) if redis.username else None,
+        password=parse.unquote(redis.password) if redis.password else None,
+    )
+    times = []
+    try:
+        for _ in range(samples):
+            start = time.perf_counter()
+            conn.call("PING")
+            times.append(time.perf_counter() - start)
+    finally:
+        conn.close()
+    return times
+
+
+def bench_target(destination_url, host, port, samples, copy_rows):
+    """Run every measurement against host:port and return them by name."""
+    url = parse.urlsplit(destination_url)
+    results = {"tcp_connect": percentiles(bench_tcp_connect(host, port, samples))}
+    try:
+        if url.scheme == "redis":
+            results["redis_ping"] = percentiles(
+                bench_redis_ping(host, port, destination_url, samples)
+            )
+            return results
+        results["pg_ping"] = percentiles(bench_pg_ping(host, port, samples))
+        psql_url = local_psql_url(destination_url, host, port)
+        env = dict(os.environ, **psql_environ(10))
+        results["psql_connect"] = percentiles(
+            bench_psql_connect(psql_url, env, min(samples, 10))
+        )
+        results["query_rtt"] = percentiles(bench_psql_queries(psql_url, env, samples))
+        total, seconds = bench_copy_out(psql_url, env, copy_rows)
+        results["copy_out_mb_per_s"] = total / seconds / 1e6
+    except (OSError, RedisError) as e:
+        results["error"] = str(e)
+    return results
+
+
+def print_bench(columns):
+    names = []
+    for results in columns.values():
+        names.extend(n for n in results if n not in names)
+    print(f"{'measurement':<24}" + "".join(f"{c:>16}" for c in columns))
+    for name in names:
+        rows = {}
+        for column, results in columns.items():
+            value = results.get(name)
+            if isinstance(value, dict):
+                for stat, seconds in value.items():
+                    rows.setdefault(f"{name} {stat} ms", {})[column] = f"{seconds * 1000:.2f}"
+            elif isinstance(value, float):
+                rows.setdefault(name, {})[column] = f"{value:.1f}"
+            elif value is not None:
+                rows.setdefault(name, {})[column] = str(value)
+        for label, values in rows.items():
+            print(f"{label:<24}" + "".join(f"{values.get(c, '-'):>16}" for c in columns))
+
+
+def bench_command(args):
+    url = parse.urlsplit(args.destination_url)
+    remote_port = url.port or default_remote_ports.get(url.scheme)
+    forward = find_tunnel_forward(args.bastion_host, args.destination_url, remote_port)
+    sshp = None
+    columns = {}
+    setup = None
+    try:
+        if forward:
+            local_host, local_port = forward["local_host"], forward["local_port"]
+            if args.show_commands:
+                print(
+                    f"using persistent tunnel {local_host}:{local_port}",
+                    file=sys.stderr,
+                )
+                return
+        else:
+            local_host, local_port = args.local_host, allocate_local_port(args.local_host)
+            sshp = ssh_port_forward(
+                args.destination_url,
+                args.bastion_host,
+                local_port,
+                remote_port,
+                args.ssh_verbose,
+                args.ssh_config,
+                show_commands=args.show_commands,
+            )
+            if args.show_commands:
+                return
+            setup = wait_for_tunnel(local_host, local_port, sshp, args.wait_seconds)
+        columns["tunnel"] = bench_target(
+            args.destination_url, local_host, local_port, args.samples, args.copy_rows
+        )
+        columns["tunnel"]["tunnel_setup_s"] = setup
+    except (TunnelError, OSError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        sys.exit(130)
+    finally:
+        if sshp is not None:
+            sshp.terminate()
+    if args.direct:
+        try:
+            socket.create_connection((url.hostname, remote_port), timeout=2).close()
+        except OSError as e:
+            print(f"direct connection not possible: {e}", file=sys.stderr)
+        else:
+            try:
+                columns["direct"] = bench_target(
+                    args.destination_url,
+                    url.hostname,
+                    remote_port,
+                    args.samples,
+                    args.copy_rows,
+                )
+            except KeyboardInterrupt:
+                sys.exit(130)
+    print_bench(columns)
+
+
+def tunnel_command(args):
+    try:
+        if args.tunnel_action == "start":
+            if not args.bastion_host or not args.destination_urls:
+                raise TunnelError("tunnel start needs a bastion and destination URLs")
+            tunnel_start(
+                args.bastion_host,
+                args.destination_urls,
+                local_ports=args.local_ports,
+                local_host=args.local_host,
+                ssh_verbose=args.ssh_verbose,
+                ssh_config=args.ssh_config,
+                show_commands=args.show_commands,
+            )
+            if not args.show_commands:
+                tunnel_status(args.bastion_host, args.ssh_config)
+        elif args.tunnel_action == "status":
+            tunnel_status(args.bastion_host, args.ssh_config)
+        elif args.tunnel_action == "stop":
+            tunnel_stop(args.bastion_host, args.ssh_config)
+    except TunnelError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     main()
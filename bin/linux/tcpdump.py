@@ -1,187 +1,825 @@
 #!/usr/bin/env python3
-import socket, sys
+import socket, sys, time, argparse, mmap, select, re, ctypes
 from struct import *
 
+# define ETH_P_ALL    0x0003          /* Every packet (be careful!!!) */
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+# <linux/if_packet.h>, not exported by the socket module
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# headers are unpacked in place from the receive buffers, these are compiled once
+eth_length = 14
+eth_type = Struct("!H")
+ip_header = Struct("!BBHHHBBH4s4s")
+tcp_header = Struct("!HHLLBBHHH")
+icmp_header = Struct("!BBH")
+udp_header = Struct("!HHHH")
+# struct tpacket_stats { unsigned int tp_packets; unsigned int tp_drops; }
+packet_stats = Struct("II")
+# struct tpacket_req3, the PACKET_RX_RING geometry: block_size, block_nr,
+# frame_size, frame_nr, retire_blk_tov, sizeof_priv, feature_req_word
+tpacket_req3 = Struct("IIIIIII")
+# struct tpacket_block_desc: the tpacket_hdr_v1 block_status, num_pkts and
+# offset_to_first_pkt fields start 8 bytes into every block
+block_status = Struct("I")
+block_status_offset = 8
+block_header = Struct("III")
+# struct tpacket3_hdr: next_offset, sec, nsec, snaplen, len, status, mac, net
+tpacket3_hdr = Struct("IIIIIIHH")
+
+pcap_header = Struct("=IHHiIII")
+pcap_record = Struct("=IIII")
+pcap_magic = 0xA1B2C3D4
+pcap_magic_nsec = 0xA1B23C4D
+linktype_ethernet = 1
 
 # Convert a string of 6 characters of ethernet address into a dash separated hex string
 def eth_addr(a):
-    b = "%.2x:%.2x:%.2x:%.2x:%.2x:%.2x" % (
-        ord(a[0]),
-        ord(a[1]),
-        ord(a[2]),
-        ord(a[3]),
-        ord(a[4]),
-        ord(a[5]),
-    )
+    b = "%.2x:%.2x:%.2x:%.2x:%.2x:%.2x" % (a[0], a[1], a[2], a[3], a[4], a[5])
     return b
 
 
-# create a AF_PACKET type raw socket (thats basically packet level)
-# define ETH_P_ALL    0x0003          /* Every packet (be careful!!!) */
-try:
-    s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(0x0003))
-except socket.error as msg:
-    print(
-        "Socket could not be created. Error Code : "
-        + str(msg[0])
-        + " Message "
-        + msg[1]
-    )
-    sys.exit()
-
-# receive a packet
-while True:
-    packet = s.recvfrom(65565)
-
-    # packet string from tuple
-    packet = packet[0]
-
-    # parse ethernet header
-    eth_length = 14
-
-    eth_header = packet[:eth_length]
-    eth = unpack("!6s6sH", eth_header)
-    eth_protocol = socket.ntohs(eth[2])
-    # print('Destination MAC : ' + eth_addr(packet[0:6]) + ' Source MAC : ' + eth_addr(packet[6:12]) + ' Protocol : ' + str(eth_protocol))
-
-    # Parse IP packets, IP Protocol number = 8
-    if eth_protocol == 8:
-        # Parse IP header
-        # take first 20 characters for the ip header
-        ip_header = packet[eth_length : 20 + eth_length]
-
-        # now unpack them :)
-        iph = unpack("!BBHHHBBH4s4s", ip_header)
-
-        version_ihl = iph[0]
-        version = version_ihl >> 4
-        ihl = version_ihl & 0xF
-
-        iph_length = ihl * 4
-
-        ttl = iph[5]
-        protocol = iph[6]
-        s_addr = socket.inet_ntoa(iph[8])
-        d_addr = socket.inet_ntoa(iph[9])
-        if str(s_addr).startswith("192.168.1") or str(s_addr).startswith("127.0"):
-            continue
+class Counters(object):
+    def __init__(self):
+        self.received = 0
+        self.parsed = 0
+        self.filtered = 0
+        self.truncated = 0
+        self.dropped = 0
+        self.started = time.monotonic()
 
+    def report(self, file=sys.stderr):
+        elapsed = time.monotonic() - self.started
         print(
-            "Version : "
-            + str(version)
-            + " IP Header Length : "
-            + str(ihl)
-            + " TTL : "
-            + str(ttl)
-            + " Protocol : "
-            + str(protocol)
-            + " Source Address : "
-            + str(s_addr)
-            + " Destination Address : "
-            + str(d_addr)
+            f"received {self.received} parsed {self.parsed} "
+            f"filtered {self.filtered} truncated {self.truncated} "
+            f"dropped {self.dropped} in {elapsed:.2f}s",
+            file=file,
         )
 
-        # TCP protocol
-        if protocol == 6:
-            t = iph_length + eth_length
-            tcp_header = packet[t : t + 20]
-
-            # now unpack them :)
-            tcph = unpack("!HHLLBBHHH", tcp_header)
-
-            source_port = tcph[0]
-            dest_port = tcph[1]
-            sequence = tcph[2]
-            acknowledgement = tcph[3]
-            doff_reserved = tcph[4]
-            tcph_length = doff_reserved >> 4
-
-            print(
-                "Source Port : "
-                + str(source_port)
-                + " Dest Port : "
-                + str(dest_port)
-                + " Sequence Number : "
-                + str(sequence)
-                + " Acknowledgement : "
-                + str(acknowledgement)
-                + " TCP header length : "
-                + str(tcph_length)
-            )
-
-            h_size = eth_length + iph_length + tcph_length * 4
-            data_size = len(packet) - h_size
 
-            # get data from the packet
-            data = packet[h_size:]
+def format_packet(packet):
+    # packet is a memoryview of one frame, returns its text or None to skip it
+    (eth_protocol,) = eth_type.unpack_from(packet, 12)
+    if eth_protocol != ETH_P_IP:
+        return None
 
-            # print('Data : ' + data)
+    version_ihl, _, _, _, _, ttl, protocol, _, s_raw, d_raw = ip_header.unpack_from(
+        packet, eth_length
+    )
+    version = version_ihl >> 4
+    ihl = version_ihl & 0xF
+    iph_length = ihl * 4
+
+    s_addr = socket.inet_ntoa(s_raw)
+    d_addr = socket.inet_ntoa(d_raw)
+
+    out = [
+        f"Version : {version} IP Header Length : {ihl} TTL : {ttl} "
+        f"Protocol : {protocol} Source Address : {s_addr} "
+        f"Destination Address : {d_addr}\n"
+    ]
+    t = iph_length + eth_length
+
+    # TCP protocol
+    if protocol == 6:
+        source_port, dest_port, sequence, acknowledgement, doff_reserved, *_ = (
+            tcp_header.unpack_from(packet, t)
+        )
+        tcph_length = doff_reserved >> 4
+        out.append(
+            f"Source Port : {source_port} Dest Port : {dest_port} "
+            f"Sequence Number : {sequence} Acknowledgement : {acknowledgement} "
+            f"TCP header length : {tcph_length}\n"
+        )
 
-        # ICMP Packets
-        elif protocol == 1:
-            u = iph_length + eth_length
-            icmph_length = 4
-            icmp_header = packet[u : u + 4]
+    # ICMP Packets
+    elif protocol == 1:
+        icmp_type, code, checksum = icmp_header.unpack_from(packet, t)
+        out.append(f"Type : {icmp_type} Code : {code} Checksum : {checksum}\n")
+        out.append(f"Data : {bytes(packet[t + icmp_header.size :])}\n")
+
+    # UDP packets
+    elif protocol == 17:
+        source_port, dest_port, length, checksum = udp_header.unpack_from(packet, t)
+        out.append(
+            f"Source Port : {source_port} Dest Port : {dest_port} "
+            f"Length : {length} Checksum : {checksum}\n"
+        )
+        out.append(f"Data : {bytes(packet[t + udp_header.size :])}\n")
+
+    # some other IP packet like IGMP
+    else:
+        out.append("Protocol other than TCP/UDP/ICMP\n")
+
+    out.append("\n")
+    return "".join(out)
+
+
+# classic BPF, <linux/filter.h>
+SO_ATTACH_FILTER = 26
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_ALU = 0x04
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+BPF_K = 0x00
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MSH = 0xA0
+BPF_AND = 0x50
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_JSET = 0x40
+# struct sock_filter { __u16 code; __u8 jt; __u8 jf; __u32 k; }
+sock_filter = Struct("HBBI")
+# struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+sock_fprog = Struct("HP")
+bpf_accept = 0x40000
+
+# frames from the local network and loopback are not interesting
+default_filter = "ip and not src net 192.168.1.0/24 and not src net 127.0.0.0/16"
+filter_protos = {"tcp": 6, "udp": 17, "icmp": 1}
+# offsets into an ethernet frame carrying IPv4
+ip_offset = {"src": eth_length + 12, "dst": eth_length + 16}
+port_offset = {"src": eth_length, "dst": eth_length + 2}
+
+
+def tokenize_filter(expr):
+    tokens = re.findall(r"\(|\)|&&|\|\||!|[^\s()!]+", expr)
+    aliases = {"&&": "and", "||": "or", "!": "not"}
+    return [aliases.get(t, t) for t in tokens]
+
+
+def parse_ip(addr):
+    # hostnames are not resolved, a filter compiled from DNS would go stale
+    try:
+        if not re.match(r"^\d+\.\d+\.\d+\.\d+$", addr):
+            raise OSError
+        return unpack("!I", socket.inet_aton(addr))[0]
+    except OSError:
+        raise ValueError(f"bad address {addr}, expected dotted quad IPv4")
+
+
+def parse_net(net):
+    # a.b.c.d/bits, or a partial address like 192.168.1 meaning a /24
+    addr, _, bits = net.partition("/")
+    parts = addr.split(".")
+    if not bits:
+        bits = 8 * len(parts)
+    addr = ".".join(parts + ["0"] * (4 - len(parts)))
+    bits = int(bits)
+    if not 0 <= bits <= 32:
+        raise ValueError(f"bad netmask in {net}")
+    mask = (0xFFFFFFFF << (32 - bits)) & 0xFFFFFFFF
+    return parse_ip(addr) & mask, mask
+
+
+def parse_port(port):
+    if port.isdigit() and int(port) < 65536:
+        return int(port)
+    try:
+        return socket.getservbyname(port)
+    except OSError:
+        raise ValueError(f"unknown port {port}")
+
+
+def parse_filter(expr):
+    # expr := term ("or" term)*, term := factor ("and" factor)*,
+    # factor := "not" factor | "(" expr ")" | [src|dst] host|net|port ARG | proto
+    tokens = tokenize_filter(expr)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def take(what="an expression"):
+        token = peek()
+        if token is None:
+            raise ValueError(f"filter ends where {what} was expected")
+        pos[0] += 1
+        return token
+
+    def parse_or():
+        node = parse_and()
+        while peek() == "or":
+            take()
+            node = ("or", node, parse_and())
+        return node
+
+    def parse_and():
+        node = parse_factor()
+        while peek() == "and":
+            take()
+            node = ("and", node, parse_factor())
+        return node
+
+    def parse_factor():
+        token = take()
+        if token == "not":
+            return ("not", parse_factor())
+        if token == "(":
+            node = parse_or()
+            if take("')'") != ")":
+                raise ValueError("expected ')'")
+            return node
+        if token == "ip":
+            return ("ip",)
+        if token in filter_protos:
+            return ("proto", filter_protos[token])
+        direction = None
+        if token in ["src", "dst"]:
+            direction, token = token, take("host, net or port")
+        if token == "host":
+            return ("host", direction, parse_ip(take("an address")))
+        if token == "net":
+            return ("net", direction) + parse_net(take("a network"))
+        if token == "port":
+            return ("port", direction, parse_port(take("a port")))
+        raise ValueError(f"unexpected {token!r} in filter")
+
+    node = parse_or()
+    if peek() is not None:
+        raise ValueError(f"unexpected {peek()!r} in filter")
+    return node
+
+
+def match_node(node, packet):
+    # the same loads, in the same order, as the compiled program, so a frame
+    # too short for one raises struct.error just where BPF would return 0
+    kind = node[0]
+    if kind == "and":
+        return match_node(node[1], packet) and match_node(node[2], packet)
+    if kind == "or":
+        return match_node(node[1], packet) or match_node(node[2], packet)
+    if kind == "not":
+        return not match_node(node[1], packet)
+    if eth_type.unpack_from(packet, 12)[0] != ETH_P_IP:
+        return False
+    if kind == "ip":
+        return True
+    if kind == "proto":
+        return packet[eth_length + 9] == node[1]
+    directions = [node[1]] if node[1] else ["src", "dst"]
+    if kind == "host":
+        return any(
+            unpack_from("!I", packet, ip_offset[d])[0] == node[2] for d in directions
+        )
+    if kind == "net":
+        return any(
+            unpack_from("!I", packet, ip_offset[d])[0] & node[3] == node[2]
+            for d in directions
+        )
+    # port: only for unfragmented TCP and UDP
+    if packet[eth_length + 9] not in [6, 17]:
+        return False
+    if unpack_from("!H", packet, eth_length + 6)[0] & 0x1FFF:
+        return False
+    x = (packet[eth_length] & 0xF) * 4
+    return any(
+        unpack_from("!H", packet, x + port_offset[d])[0] == node[2] for d in directions
+    )
 
-            # now unpack them :)
-            icmph = unpack("!BBH", icmp_header)
 
-            icmp_type = icmph[0]
-            code = icmph[1]
-            checksum = icmph[2]
+def filter_matcher(node):
+    def match(packet):
+        try:
+            return match_node(node, packet)
+        except (error, IndexError):
+            return False
+
+    return match
+
+
+class BpfCompiler(object):
+    # instructions are [code, jt, jf, k] with jt and jf as labels, None meaning
+    # the next instruction, resolved to relative offsets once everything is placed
+
+    def __init__(self):
+        self.insns = []
+        self.labels = {}
+        self.next_label = 0
+
+    def label(self):
+        self.next_label += 1
+        return self.next_label
+
+    def place(self, label):
+        self.labels[label] = len(self.insns)
+
+    def emit(self, code, k=0, jt=None, jf=None):
+        self.insns.append([code, jt, jf, k])
+
+    def compile(self, node):
+        accept, reject = self.label(), self.label()
+        self.gen(node, accept, reject)
+        self.place(accept)
+        self.emit(BPF_RET | BPF_K, bpf_accept)
+        self.place(reject)
+        self.emit(BPF_RET | BPF_K, 0)
+        program = []
+        for i, (code, jt, jf, k) in enumerate(self.insns):
+            jt, jf = [0 if j is None else self.labels[j] - i - 1 for j in (jt, jf)]
+            if jt > 255 or jf > 255:
+                raise ValueError("filter too long for classic BPF jumps")
+            program.append((code, jt, jf, k))
+        return program
+
+    def gen(self, node, t, f):
+        kind = node[0]
+        if kind in ["and", "or"]:
+            middle = self.label()
+            if kind == "and":
+                self.gen(node[1], middle, f)
+            else:
+                self.gen(node[1], t, middle)
+            self.place(middle)
+            self.gen(node[2], t, f)
+            return
+        if kind == "not":
+            self.gen(node[1], f, t)
+            return
+        self.emit(BPF_LD | BPF_H | BPF_ABS, 12)
+        if kind == "ip":
+            self.emit(BPF_JMP | BPF_JEQ | BPF_K, ETH_P_IP, t, f)
+            return
+        self.emit(BPF_JMP | BPF_JEQ | BPF_K, ETH_P_IP, None, f)
+        if kind == "proto":
+            self.emit(BPF_LD | BPF_B | BPF_ABS, eth_length + 9)
+            self.emit(BPF_JMP | BPF_JEQ | BPF_K, node[1], t, f)
+            return
+        directions = [node[1]] if node[1] else ["src", "dst"]
+        if kind == "port":
+            tcp_or_udp = self.label()
+            self.emit(BPF_LD | BPF_B | BPF_ABS, eth_length + 9)
+            self.emit(BPF_JMP | BPF_JEQ | BPF_K, 6, tcp_or_udp, None)
+            self.emit(BPF_JMP | BPF_JEQ | BPF_K, 17, None, f)
+            self.place(tcp_or_udp)
+            self.emit(BPF_LD | BPF_H | BPF_ABS, eth_length + 6)
+            self.emit(BPF_JMP | BPF_JSET | BPF_K, 0x1FFF, f, None)
+            self.emit(BPF_LDX | BPF_B | BPF_MSH, eth_length)
+        for i, direction in enumerate(directions):
+            last = i == len(directions) - 1
+            if kind == "port":
+                self.emit(BPF_LD | BPF_H | BPF_IND, port_offset[direction])
+            else:
+                self.emit(BPF_LD | BPF_W | BPF_ABS, ip_offset[direction])
+            if kind == "net":
+                self.emit(BPF_ALU | BPF_AND | BPF_K, node[3])
+            self.emit(BPF_JMP | BPF_JEQ | BPF_K, node[2], t, f if last else None)
+
+
+def compile_filter(node):
+    return BpfCompiler().compile(node)
+
+
+def run_bpf(program, packet):
+    # a classic BPF interpreter, for checking the compiler against match_node
+    a = x = pc = 0
+    size = len(packet)
+    sizes = {BPF_W: 4, BPF_H: 2, BPF_B: 1}
+    while True:
+        code, jt, jf, k = program[pc]
+        pc += 1
+        cls = code & 0x07
+        if cls == BPF_LD:
+            offset = k + x if code & 0xE0 == BPF_IND else k
+            width = sizes[code & 0x18]
+            if offset + width > size:
+                return 0
+            a = int.from_bytes(packet[offset : offset + width], "big")
+        elif cls == BPF_LDX:
+            if k >= size:
+                return 0
+            x = (packet[k] & 0xF) * 4
+        elif cls == BPF_ALU:
+            a &= k
+        elif cls == BPF_JMP:
+            op = code & 0xF0
+            if op == BPF_JA:
+                pc += k
+            elif op == BPF_JEQ:
+                pc += jt if a == k else jf
+            elif op == BPF_JSET:
+                pc += jt if a & k else jf
+        elif cls == BPF_RET:
+            return k
+
+
+def dump_filter(program, file=sys.stdout):
+    # in the style of tcpdump -d
+    names = {
+        BPF_LD | BPF_W | BPF_ABS: "ld       [{k}]",
+        BPF_LD | BPF_H | BPF_ABS: "ldh      [{k}]",
+        BPF_LD | BPF_B | BPF_ABS: "ldb      [{k}]",
+        BPF_LD | BPF_H | BPF_IND: "ldh      [x + {k}]",
+        BPF_LDX | BPF_B | BPF_MSH: "ldxb     4*([{k}]&0xf)",
+        BPF_ALU | BPF_AND | BPF_K: "and      #{k:#x}",
+        BPF_JMP | BPF_JEQ | BPF_K: "jeq      #{k:#x}           jt {jt}\tjf {jf}",
+        BPF_JMP | BPF_JSET | BPF_K: "jset     #{k:#x}           jt {jt}\tjf {jf}",
+        BPF_RET | BPF_K: "ret      #{k}",
+    }
+    for i, (code, jt, jf, k) in enumerate(program):
+        text = names[code].format(k=k, jt=i + 1 + jt, jf=i + 1 + jf)
+        print(f"({i:03d}) {text}", file=file)
+
+
+def attach_filter(s, program):
+    # the kernel copies the program during setsockopt, so buf only has to live
+    # until it returns
+    buf = ctypes.create_string_buffer(
+        b"".join(sock_filter.pack(*insn) for insn in program)
+    )
+    s.setsockopt(
+        socket.SOL_SOCKET,
+        SO_ATTACH_FILTER,
+        sock_fprog.pack(len(program), ctypes.addressof(buf)),
+    )
 
-            print(
-                "Type : "
-                + str(icmp_type)
-                + " Code : "
-                + str(code)
-                + " Checksum : "
-                + str(checksum)
-            )
 
-            h_size = eth_length + iph_length + icmph_length
-            data_size = len(packet) - h_size
-
-            # get data from the packet
-            data = packet[h_size:]
-
-            print("Data : " + str(data))
-
-        # UDP packets
-        elif protocol == 17:
-            u = iph_length + eth_length
-            udph_length = 8
-            udp_header = packet[u : u + 8]
-
-            # now unpack them :)
-            udph = unpack("!HHHH", udp_header)
-
-            source_port = udph[0]
-            dest_port = udph[1]
-            length = udph[2]
-            checksum = udph[3]
-
-            print(
-                "Source Port : "
-                + str(source_port)
-                + " Dest Port : "
-                + str(dest_port)
-                + " Length : "
-                + str(length)
-                + " Checksum : "
-                + str(checksum)
+def install_filter(s, program):
+    # frames queued before the filter was attached got in unfiltered: attach a
+    # reject everything program, drain the queue, then attach the real one
+    attach_filter(s, [(BPF_RET | BPF_K, 0, 0, 0)])
+    while True:
+        try:
+            s.recv(1, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            break
+    attach_filter(s, program)
+
+
+def check_filter(node, frames):
+    # the python evaluator and the compiled program must agree on every frame,
+    # on a fragment and an ARP copy of it, and on truncated copies of all three
+    program = compile_filter(node)
+    match = filter_matcher(node)
+    checked = mismatched = 0
+    for frame in frames:
+        frame = bytes(frame)
+        fragment = frame[:20] + b"\x00\x10" + frame[22:]
+        arp = frame[:12] + b"\x08\x06" + frame[14:]
+        for variant in [frame, fragment, arp]:
+            for n in [len(variant), 13, 20, 30, 34, 36, 38]:
+                checked += 1
+                if match(variant[:n]) != bool(run_bpf(program, variant[:n])):
+                    mismatched += 1
+                    if mismatched <= 10:
+                        print(f"mismatch on {variant[:n].hex()}", file=sys.stderr)
+    print(f"checked {checked} frames, {mismatched} mismatched", file=sys.stderr)
+    return mismatched == 0
+
+
+def format_batch(packets, counters, match=None):
+    # match filters in python when the kernel could not do it
+    out = []
+    for packet in packets:
+        counters.received += 1
+        if match is not None and not match(packet):
+            counters.filtered += 1
+            continue
+        try:
+            text = format_packet(packet)
+        except error:
+            counters.truncated += 1
+            continue
+        if text is not None:
+            counters.parsed += 1
+            out.append(text)
+    return "".join(out)
+
+
+def open_socket(interface=None):
+    # create a AF_PACKET type raw socket (thats basically packet level)
+    try:
+        s = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(ETH_P_ALL))
+        if interface:
+            s.bind((interface, 0))
+    except OSError as msg:
+        print(
+            f"Socket could not be created. Error Code : {msg.errno} "
+            f"Message {msg.strerror}"
+        )
+        sys.exit(1)
+    return s
+
+
+def open_filtered_socket(interface, program, match):
+    # returns the socket and the python matcher still needed, None once the
+    # kernel runs the filter
+    s = open_socket(interface)
+    if program is None:
+        return s, None
+    try:
+        install_filter(s, program)
+    except OSError as e:
+        print(f"BPF filter not attached ({e}), filtering in python", file=sys.stderr)
+        return s, match
+    return s, None
+
+
+def read_drops(s, counters):
+    # the kernel resets its counters on every read
+    _, drops = packet_stats.unpack(
+        s.getsockopt(SOL_PACKET, PACKET_STATISTICS, packet_stats.size)
+    )
+    counters.dropped += drops
+
+
+def capture(s, counters, ring_size, snaplen, match=None, out=sys.stdout):
+    # a preallocated ring of receive buffers, filled recvmmsg style: block for
+    # the first frame, then drain whatever else is queued without blocking
+    ring = [memoryview(bytearray(snaplen)) for _ in range(ring_size)]
+    drops_read = time.monotonic()
+    while True:
+        batch = [ring[0][: s.recv_into(ring[0])]]
+        for view in ring[1:]:
+            try:
+                n = s.recv_into(view, 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            batch.append(view[:n])
+        text = format_batch(batch, counters, match)
+        if text:
+            out.write(text)
+            out.flush()
+        if time.monotonic() - drops_read >= 1:
+            read_drops(s, counters)
+            drops_read = time.monotonic()
+
+
+def open_ring(s, block_size, block_nr, frame_size=2048, retire_tov=60):
+    # a TPACKET_V3 PACKET_RX_RING: the kernel writes frames straight into
+    # blocks of shared memory and flips each block to TP_STATUS_USER when it is
+    # full or retire_tov milliseconds old
+    block_size = -(-block_size // mmap.PAGESIZE) * mmap.PAGESIZE
+    s.setsockopt(SOL_PACKET, PACKET_VERSION, pack("i", TPACKET_V3))
+    req = tpacket_req3.pack(
+        block_size,
+        block_nr,
+        frame_size,
+        block_size // frame_size * block_nr,
+        retire_tov,
+        0,
+        0,
+    )
+    s.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+    ring = mmap.mmap(
+        s.fileno(),
+        block_size * block_nr,
+        mmap.MAP_SHARED,
+        mmap.PROT_READ | mmap.PROT_WRITE,
+    )
+    return ring, block_size
+
+
+def capture_ring(s, ring, block_size, block_nr, counters, match=None, out=sys.stdout):
+    view = memoryview(ring)
+    poller = select.poll()
+    poller.register(s, select.POLLIN | select.POLLERR)
+    drops_read = time.monotonic()
+    block = 0
+    while True:
+        offset = block * block_size
+        desc = offset + block_status_offset
+        (status,) = block_status.unpack_from(ring, desc)
+        if not status & TP_STATUS_USER:
+            poller.poll(1000)
+            continue
+        _, num_pkts, packet = block_header.unpack_from(ring, desc)
+        packet += offset
+        batch = []
+        for _ in range(num_pkts):
+            next_offset, _, _, snaplen, _, _, mac, _ = tpacket3_hdr.unpack_from(
+                ring, packet
             )
+            batch.append(view[packet + mac : packet + mac + snaplen])
+            packet += next_offset
+        text = format_batch(batch, counters, match)
+        # the frames are formatted, so the block can go back to the kernel
+        block_status.pack_into(ring, desc, TP_STATUS_KERNEL)
+        block = (block + 1) % block_nr
+        if text:
+            out.write(text)
+            out.flush()
+        if time.monotonic() - drops_read >= 1:
+            read_drops(s, counters)
+            drops_read = time.monotonic()
+
+
+def read_pcap(data):
+    # yields a zero-copy memoryview of each frame in a pcap file's contents
+    view = memoryview(data)
+    header, record = pcap_header, pcap_record
+    (magic,) = unpack_from("=I", view)
+    if magic not in [pcap_magic, pcap_magic_nsec]:
+        # written on a host of the other byte order
+        order = ">" if sys.byteorder == "little" else "<"
+        header = Struct(order + pcap_header.format[1:])
+        record = Struct(order + pcap_record.format[1:])
+    magic, _, _, _, _, _, linktype = header.unpack_from(view)
+    if magic not in [pcap_magic, pcap_magic_nsec]:
+        raise ValueError("not a pcap file")
+    if linktype != linktype_ethernet:
+        raise ValueError(f"unsupported pcap link type {linktype}")
+    offset = header.size
+    while offset + record.size <= len(view):
+        _, _, incl_len, _ = record.unpack_from(view, offset)
+        offset += record.size
+        yield view[offset : offset + incl_len]
+        offset += incl_len
+
+
+def synthetic_frame(i):
+    # a mix of TCP, UDP and ICMP, every eighth one from a filtered source
+    protocol = [6, 17, 1, 6][i % 4]
+    src = bytes([192, 168, 1, i % 250 + 1]) if i % 8 == 7 else bytes([10, 0, 0, 1])
+    dst = bytes([10, 1, i >> 8 & 0xFF, i & 0xFF])
+    payload = bytes(64 + i % 512)
+    if protocol == 6:
+        seq, ack = i, i * 7 & 0xFFFFFFFF
+        l4 = tcp_header.pack(40000 + i % 1000, 443, seq, ack, 5 << 4, 0x18, 512, 0, 0)
+    elif protocol == 17:
+        l4 = udp_header.pack(53, 40000 + i % 1000, udp_header.size + len(payload), 0)
+    else:
+        l4 = icmp_header.pack(8, 0, 0) + pack("!HH", i & 0xFFFF, 1)
+    total = ip_header.size + len(l4) + len(payload)
+    ip = ip_header.pack(0x45, 0, total, i & 0xFFFF, 0, 64, protocol, 0, src, dst)
+    eth = b"\x02\x00\x00\x00\x00\x01\x02\x00\x00\x00\x00\x02" + eth_type.pack(ETH_P_IP)
+    return eth + ip + l4 + payload
+
+
+def synthetic_pcap(count, snaplen=65535):
+    out = [pcap_header.pack(pcap_magic, 2, 4, 0, 0, snaplen, linktype_ethernet)]
+    for i in range(count):
+        frame = synthetic_frame(i)
+        ts_sec, ts_usec = divmod(i * 1000, 1000000)
+        out.append(pcap_record.pack(ts_sec, ts_usec, len(frame), len(frame)))
+        out.append(frame)
+    return b"".join(out)
+
+
+def replay(data, counters, batch_size, match=None, out=sys.stdout):
+    frames = read_pcap(data)
+    while True:
+        batch = [f for _, f in zip(range(batch_size), frames)]
+        if not batch:
+            return
+        text = format_batch(batch, counters, match)
+        if text:
+            out.write(text)
+
+
+class NullWriter(object):
+    def write(self, text):
+        pass
+
+
+def bench(data, batch_size, rounds, match=None):
+    size = len(data)
+    for _ in range(rounds):
+        counters = Counters()
+        replay(data, counters, batch_size, match, NullWriter())
+        elapsed = time.monotonic() - counters.started
+        counters.report()
+        print(
+            f"{counters.received / elapsed:.0f} packets/s "
+            f"{size / elapsed / 1e6:.1f} MB/s",
+            file=sys.stderr,
+        )
 
-            h_size = eth_length + iph_length + udph_length
-            data_size = len(packet) - h_size
-
-            # get data from the packet
-            data = packet[h_size:]
-
-            print("Data : " + str(data))
 
-        # some other IP packet like IGMP
+def main():
+    p = argparse.ArgumentParser(
+        description="print the IPv4 headers of every frame on the wire that "
+        "matches a filter, by default skipping sources in 192.168.1 and 127.0"
+    )
+    p.add_argument(
+        "-f",
+        "--filter",
+        default=default_filter,
+        help="[src|dst] host ADDR, [src|dst] net NET[/BITS], [src|dst] port PORT, "
+        "ip, tcp, udp and icmp combined with and, or, not and parentheses; "
+        "compiled to BPF and run in the kernel, an empty filter matches "
+        f"everything (default: {default_filter})",
+    )
+    p.add_argument(
+        "-d",
+        "--dump-filter",
+        action="store_true",
+        help="print the compiled BPF program and exit",
+    )
+    p.add_argument(
+        "--check-filter",
+        action="store_true",
+        help="run the filter through the python evaluator and the BPF interpreter "
+        "on --read or a synthetic pcap and report any frame they disagree on",
+    )
+    p.add_argument("-i", "--interface", help="capture on one interface only")
+    p.add_argument(
+        "-r", "--read", help="replay a pcap file through the parser instead"
+    )
+    p.add_argument(
+        "-w",
+        "--write-synthetic",
+        metavar="FILE",
+        help="write a synthetic pcap of --count frames and exit",
+    )
+    p.add_argument(
+        "--bench",
+        action="store_true",
+        help="time the parser on --read or on a synthetic pcap, discarding output",
+    )
+    p.add_argument("--count", type=int, default=100000, help="synthetic frames")
+    p.add_argument("--rounds", type=int, default=3, help="--bench repetitions")
+    p.add_argument(
+        "--ring", type=int, default=256, help="receive buffers, the batch size"
+    )
+    p.add_argument("--snaplen", type=int, default=65535, help="bytes kept per frame")
+    p.add_argument(
+        "--mmap",
+        action="store_true",
+        help="capture from a TPACKET_V3 memory mapped ring, falling back to "
+        "recv_into if the kernel does not offer one",
+    )
+    p.add_argument(
+        "--block-size", type=int, default=1 << 20, help="--mmap ring block bytes"
+    )
+    p.add_argument("--blocks", type=int, default=64, help="--mmap ring blocks")
+    p.add_argument(
+        "--stats", action="store_true", help="print counters to stderr at exit"
+    )
+    args = p.parse_args()
+    # match is what is left for python to filter once the kernel has the
+    # program, python_match the evaluator to fall back to on every new socket
+    node = program = match = python_match = None
+    if args.filter:
+        try:
+            node = parse_filter(args.filter)
+            program = compile_filter(node)
+        except ValueError as e:
+            p.error(f"bad filter: {e}")
+        match = python_match = filter_matcher(node)
+
+    if args.dump_filter:
+        dump_filter(program or [(BPF_RET | BPF_K, bpf_accept, 0, 0)])
+        return
+    if args.write_synthetic:
+        with open(args.write_synthetic, "wb") as f:
+            f.write(synthetic_pcap(args.count, args.snaplen))
+        return
+    if args.read:
+        with open(args.read, "rb") as f:
+            data = f.read()
+    elif args.bench or args.check_filter:
+        data = synthetic_pcap(args.count, args.snaplen)
+    if args.check_filter:
+        sys.exit(0 if node is None or check_filter(node, read_pcap(data)) else 1)
+    if args.bench:
+        bench(data, args.ring, args.rounds, match)
+        return
+
+    counters = Counters()
+    s = None
+    try:
+        if args.read:
+            replay(data, counters, args.ring, match)
         else:
-            print("Protocol other than TCP/UDP/ICMP")
-
-        print()
+            s, match = open_filtered_socket(args.interface, program, python_match)
+            if args.mmap:
+                try:
+                    ring, block_size = open_ring(s, args.block_size, args.blocks)
+                except OSError as e:
+                    print(
+                        f"TPACKET_V3 ring unavailable ({e}), using recv_into",
+                        file=sys.stderr,
+                    )
+                    # the socket may be left at TPACKET_V3 without a ring
+                    s.close()
+                    s, match = open_filtered_socket(
+                        args.interface, program, python_match
+                    )
+                else:
+                    capture_ring(s, ring, block_size, args.blocks, counters, match)
+            capture(s, counters, args.ring, args.snaplen, match)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+    finally:
+        if s is not None:
+            read_drops(s, counters)
+        if args.stats:
+            counters.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,110 @@
 #!/usr/bin/env python3
-import os, sys, re, argparse, json, subprocess
+import os, sys, re, argparse, json, subprocess, io, time, select, struct, difflib
+import ctypes, ctypes.util
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
 
 pam_dir = "/etc/pam.d"
+man_cache_path = os.path.expanduser(
+    os.getenv("PAMTREE_CACHE", "~/.cache/pamtree/man.json")
+)
+
+
+def man_page_name(module):
+    return re.sub(r"\.so", "", os.path.basename(module))
 
 
 def read_man_doc(module):
-    module = re.sub(r"\.so", "", module)
+    module = man_page_name(module)
     res = subprocess.run(
         f"man -c {module} | col -b", text=True, stdout=subprocess.PIPE, shell=True
     )
     return res.stdout.strip().split("\n")
 
 
+def man_page_path(module):
+    res = subprocess.run(
+        ["man", "-w", man_page_name(module)],
+        text=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    lines = res.stdout.strip().split("\n")
+    return lines[0] if res.returncode == 0 and lines[0] else None
+
+
+def man_page_mtime(path):
+    try:
+        return os.stat(path).st_mtime if path else None
+    except OSError:
+        return None
+
+
+def index_man_sections(lines):
+    """Split man page lines into {SECTION: lines} in a single pass.
+
+    Matches parse_man_section: a section runs from its heading up to the
+    next heading-like line, and only the first of repeated headings counts.
+    """
+    sections = {}
+    current = None
+    for line in lines:
+        if re.match(r"^[A-Z\s]{2,}\s*$", line):
+            name = line.strip()
+            current = name if name not in sections else None
+            if current is not None:
+                sections[current] = []
+        elif current is not None:
+            sections[current].append(line)
+    return sections
+
+
+def load_man_cache(path=None):
+    try:
+        with open(path or man_cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_man_cache(cache, path=None):
+    path = path or man_cache_path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(cache, f)
+    os.replace(path + ".tmp", path)
+
+
+def read_man_sections(modules, cache=None, workers=None):
+    """Return {module: section index}, rendering only stale pages.
+
+    Cache entries are keyed by module and hold the man page path and its
+    mtime. A page is re-rendered (in parallel with the other misses) only
+    when the file is gone or its mtime changed.
+    """
+    cache = cache if cache is not None else {}
+    missing = []
+    for module in modules:
+        entry = cache.get(module)
+        if not entry or man_page_mtime(entry["path"]) != entry["mtime"]:
+            missing.append(module)
+
+    def render(module):
+        path = man_page_path(module)
+        return module, {
+            "path": path,
+            "mtime": man_page_mtime(path),
+            "sections": index_man_sections(read_man_doc(module)),
+        }
+
+    if missing:
+        # rendering is spent waiting on man subprocesses, not on this process
+        with ThreadPoolExecutor(max_workers=workers or min(16, len(missing))) as pool:
+            for module, entry in pool.map(render, missing):
+                cache[module] = entry
+    return {module: cache[module]["sections"] for module in modules}
+
+
 def parse_man_section(lines, section):
     found = False
     section_lines = []
@@ -50,11 +143,11 @@ def match_man_paragraph(lines, mat):
     return paragraph
 
 
-def get_man_module_doc(man_lines):
-    module_name = parse_man_section(man_lines, "NAME")
-    desc_lines = parse_man_section(man_lines, "DESCRIPTION")
+def get_man_module_doc(sections):
+    module_name = sections.get("NAME", [])
+    desc_lines = sections.get("DESCRIPTION", [])
     desc_para = join_man_paragraphs(desc_lines)
-    options_ = parse_man_section(man_lines, "OPTIONS")
+    options_ = sections.get("OPTIONS", [])
     options_ = join_man_paragraphs(options_)
     options = {}
     for option in options_:
@@ -80,13 +173,12 @@ def get_desc_para(module_doc, match):
     return "\n".join(desc)
 
 
-def build_man_docs(man_docs, pam_conf):
-    modules = set([i["module"] for i in pam_conf if i["control"] != "include"])
+def build_man_docs(man_docs, pam_conf, cache=None):
+    modules = set([i["module"] for i in pam_conf if "module" in i])
+    sections = read_man_sections(sorted(modules) + ["pam.conf"], cache)
     for module in modules:
-        man_lines = read_man_doc(module)
-        man_docs[module] = get_man_module_doc(man_lines)
-    man_lines = read_man_doc("pam.conf")
-    desc_lines = parse_man_section(man_lines, "DESCRIPTION")
+        man_docs[module] = get_man_module_doc(sections[module])
+    desc_lines = sections["pam.conf"].get("DESCRIPTION", [])
     desc_para = join_man_paragraphs(desc_lines)
     options = [
         "account",
@@ -108,43 +200,650 @@ def build_man_docs(man_docs, pam_conf):
     man_docs["control"] = control
 
 
-def read_pam_conf(fn, level, stype=""):
-    prefix = ">" * level
+stypes = ["account", "auth", "password", "session"]
+include_controls = ["include", "substack"]
+
+
+def split_pam_line(line):
+    # keeps [value=action ...] controls together as one field
+    return re.findall(r"\[[^\]]*\]|\S+", line)
+
+
+def parse_pam_file(fn):
+    """Parse one PAM file into entries, without following includes."""
+    entries = []
     with open(fn) as f:
-        items = []
-        for line in f:
+        for lineno, line in enumerate(f, 1):
             line = line.strip()
-            parts = re.split(r"\s+", line)
-            if not parts[0] or parts[0][0] == "#":
+            parts = split_pam_line(line)
+            if not parts or parts[0][0] == "#":
                 continue
+            elif parts[0] == "@include" and len(parts) == 2:
+                # Debian style include of every service type
+                parts = ["", "include", parts[1]]
             elif len(parts) < 3:
-                print("unsupported", parts)
+                print("unsupported", parts, file=sys.stderr)
                 continue
-            stype_, control, module = parts[:3]
-            dash = stype_[0] == "-"
+            stype, control, module = parts[:3]
+            dash = stype[:1] == "-"
             if dash:
-                stype_ = stype_[1:]
-            if stype and stype not in [stype_, "include"]:
-                continue
+                stype = stype[1:]
             module_args = parts[3:]
-            module_arg_names = [n.split("=")[0] for n in module_args]
+            entries.append(
+                {
+                    "fn": os.path.basename(fn),
+                    "lineno": lineno,
+                    "line": line,
+                    "stype": stype,
+                    "control": control,
+                    "dash": dash,
+                    "module": module,
+                    "module_args": module_args,
+                    "module_arg_names": [n.split("=")[0] for n in module_args],
+                }
+            )
+    return entries
+
+
+class PamTree(object):
+    """PAM files parsed once each, with their include/substack graph.
+
+    Flattened stacks are memoized per (file, stype) so that shared files
+    such as common-auth are only expanded once for the whole directory.
+    Include cycles and missing files become entries with an "error" key.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or pam_dir
+        self.files = {}
+        self.stacks = {}
+        # (path, stype) -> every file, present or not, the stack was built from
+        self.deps = {}
+
+    def path(self, name):
+        return os.path.abspath(os.path.join(self.directory, name))
+
+    def parse(self, path):
+        path = os.path.abspath(path)
+        if path not in self.files:
+            self.files[path] = parse_pam_file(path)
+        return self.files[path]
+
+    def invalidate(self, path):
+        """Forget path and every memoized stack that was built from it."""
+        path = os.path.abspath(path)
+        self.files.pop(path, None)
+        for key in [k for k, deps in self.deps.items() if path in deps]:
+            self.stacks.pop(key, None)
+            del self.deps[key]
+
+    def services(self):
+        return sorted(
+            name
+            for name in os.listdir(self.directory)
+            if not name.startswith(".") and os.path.isfile(self.path(name))
+        )
+
+    def expand(self, path, stype="", chain=()):
+        """Return ([(depth, entry)...], cyclic) for path with includes followed."""
+        path = os.path.abspath(path)
+        if (path, stype) in self.stacks:
+            return self.stacks[(path, stype)], False
+        chain = chain + (path,)
+        expanded = []
+        cyclic = False
+        deps = set([path])
+        for entry in self.parse(path):
+            if stype and entry["stype"] and stype not in [entry["stype"], "include"]:
+                continue
+            expanded.append((0, entry))
+            if entry["control"] not in include_controls:
+                continue
+            target = self.path(entry["module"])
+            deps.add(target)
+            if target in chain:
+                cyclic = True
+                names = [os.path.basename(c) for c in chain + (target,)]
+                error = "include cycle: " + " -> ".join(names)
+            elif not os.path.isfile(target):
+                error = f"missing include: {target}"
+            else:
+                sub_stype = entry["stype"] or stype
+                sub, sub_cyclic = self.expand(target, sub_stype, chain)
+                deps.update(self.deps[(target, sub_stype)])
+                cyclic = cyclic or sub_cyclic
+                expanded.extend((depth + 1, e) for depth, e in sub)
+                continue
+            expanded.append(
+                (
+                    1,
+                    {
+                        "fn": entry["fn"],
+                        "line": "!! " + error,
+                        "stype": entry["stype"],
+                        "control": "error",
+                        "dash": False,
+                        "error": error,
+                    },
+                )
+            )
+        self.deps[(path, stype)] = deps
+        # a stack cut short by a cycle depends on the chain it was reached by
+        if not cyclic:
+            self.stacks[(path, stype)] = expanded
+        return expanded, cyclic
+
+    def items(self, path, level=1, stype=""):
+        items = []
+        for depth, entry in self.expand(path, stype)[0]:
             item = {
-                "fn": os.path.basename(fn),
-                "prefix": prefix,
-                "line": line,
-                "stype": stype_,
-                "control": control,
-                "dash": dash,
+                "fn": entry["fn"],
+                "prefix": ">" * (level + depth),
+                "line": entry["line"],
+                "stype": entry["stype"],
+                "control": entry["control"],
+                "dash": entry["dash"],
             }
-            if control != "include":
-                item["module"] = module
-                item["module_args"] = module_args
-                item["module_arg_names"] = module_arg_names
+            if "error" in entry:
+                item["error"] = entry["error"]
+            elif entry["control"] not in include_controls:
+                item["module"] = entry["module"]
+                item["module_args"] = entry["module_args"]
+                item["module_arg_names"] = entry["module_arg_names"]
             items.append(item)
-            if control == "include":
-                lines = read_pam_conf(os.path.join(pam_dir, module), level + 1, stype_)
-                items.extend(lines)
-    return items
+        return items
+
+    def graph(self):
+        return {
+            name: sorted(
+                set(
+                    e["module"]
+                    for e in self.parse(self.path(name))
+                    if e["control"] in include_controls
+                )
+            )
+            for name in self.services()
+        }
+
+    def analyse(self):
+        """Flatten every service for every stype and index modules by service."""
+        stacks = {}
+        modules = {}
+        errors = []
+        for name in self.services():
+            stacks[name] = {}
+            for stype in stypes:
+                items = self.items(self.path(name), 1, stype)
+                stacks[name][stype] = items
+                for item in items:
+                    if "module" in item:
+                        modules.setdefault(item["module"], set()).add(name)
+                    elif "error" in item and item["error"] not in errors:
+                        errors.append(item["error"])
+        return {
+            "graph": self.graph(),
+            "stacks": stacks,
+            "modules": {m: sorted(s) for m, s in sorted(modules.items())},
+            "errors": errors,
+        }
+
+
+# the historical control keywords as value=action tables, see pam.conf(5)
+standard_controls = {
+    "required": {
+        "success": "ok",
+        "new_authtok_reqd": "ok",
+        "ignore": "ignore",
+        "default": "bad",
+    },
+    "requisite": {
+        "success": "ok",
+        "new_authtok_reqd": "ok",
+        "ignore": "ignore",
+        "default": "die",
+    },
+    "sufficient": {
+        "success": "done",
+        "new_authtok_reqd": "done",
+        "default": "ignore",
+    },
+    "optional": {"success": "ok", "new_authtok_reqd": "ok", "default": "ignore"},
+}
+# returned by a stack that no module gave a positive impression
+must_fail_code = "perm_denied"
+
+
+def parse_control(control):
+    if control in standard_controls:
+        return dict(standard_controls[control])
+    actions = {}
+    for pair in control.strip("[]").split():
+        value, _, action = pair.partition("=")
+        actions[value.lower()] = action.lower()
+    return actions
+
+
+class StackSimulator(object):
+    """Compile a flattened stack into a program and evaluate module outcomes.
+
+    Evaluation follows libpam's dispatcher: an impression and a status are
+    carried through the stack, done and die skip to the end of the
+    enclosing substack, reset restores the state as of entering it, and a
+    jump counts a whole substack as one module and cannot leave it.
+    Includes are inlined.
+    """
+
+    def __init__(self, expanded):
+        self.ops = []
+        self.modules = []
+        scopes = []
+        for depth, entry in expanded:
+            while scopes and depth <= scopes[-1][0]:
+                self.leave(scopes.pop()[1])
+            if entry["control"] == "substack":
+                scopes.append((depth, len(self.ops)))
+                self.ops.append({"op": "enter", "level": len(scopes) - 1})
+            elif entry["control"] == "include":
+                continue
+            else:
+                op = {"op": "module", "entry": entry, "step": len(self.modules) + 1}
+                if "error" in entry:
+                    # a broken include makes libpam fail the whole stack
+                    op["actions"] = {"default": "bad"}
+                    op["outcomes"] = ["error"]
+                else:
+                    op["actions"] = parse_control(entry["control"])
+                    op["outcomes"] = self.outcomes(entry["control"], op["actions"])
+                self.ops.append(op)
+                self.modules.append(op)
+        while scopes:
+            self.leave(scopes.pop()[1])
+        ends = [len(self.ops)]
+        for pc, op in enumerate(self.ops):
+            if op["op"] == "enter":
+                ends.append(op["end"])
+            elif op["op"] == "leave":
+                ends.pop()
+            else:
+                op["end"] = ends[-1]
+        self.memo = {}
+
+    def leave(self, enter):
+        self.ops[enter]["end"] = len(self.ops)
+        self.ops.append({"op": "leave"})
+
+    @staticmethod
+    def action(actions, code):
+        return actions.get(code, actions.get("default", "bad"))
+
+    def outcomes(self, control, actions):
+        """One representative module result per distinct effect on the stack."""
+        codes = ["success", "fail", "ignore"]
+        if control not in standard_controls:
+            codes += [c for c in actions if c not in codes + ["default"]]
+        outcomes = []
+        seen = set()
+        for code in codes:
+            action = self.action(actions, code)
+            if action in ["ok", "done"]:
+                key = (action, code if code in ["success", "ignore"] else "fail")
+            else:
+                key = (action, None)
+            if key not in seen:
+                seen.add(key)
+                outcomes.append(code)
+        return outcomes
+
+    def jump(self, pc, count):
+        for _ in range(count):
+            pc += 1
+            if pc >= len(self.ops) or self.ops[pc]["op"] == "leave":
+                return pc
+            if self.ops[pc]["op"] == "enter":
+                pc = self.ops[pc]["end"]
+        return pc + 1
+
+    def step(self, pc, state, outcome):
+        """Apply one module result, returning (action, next pc, next state)."""
+        impression, status, saved = state
+        op = self.ops[pc]
+        code = outcome
+        if outcome == "missing":
+            code = "ignore" if op["entry"]["dash"] else "module_unknown"
+        action = self.action(op["actions"], code)
+        next_pc = pc + 1
+        if action == "reset":
+            impression, status = saved[-1] if saved else (None, must_fail_code)
+        elif action in ["ok", "done"]:
+            if impression is None or (impression and status == "success"):
+                if code != "ignore":
+                    impression, status = True, code
+            if action == "done" and impression is not False:
+                next_pc = op["end"]
+        elif action in ["bad", "die"]:
+            if impression is not False:
+                # libpam never keeps a success status on a failing action
+                impression = False
+                status = must_fail_code if code == "success" else code
+            if action == "die":
+                next_pc = op["end"]
+        elif action.isdigit():
+            next_pc = self.jump(pc, int(action))
+        return action, next_pc, (impression, status, saved)
+
+    def advance(self, pc, state):
+        """Run enter/leave bookkeeping up to the next module or the end."""
+        impression, status, saved = state
+        while pc < len(self.ops) and self.ops[pc]["op"] != "module":
+            if self.ops[pc]["op"] == "enter":
+                saved = saved + ((impression, status),)
+            else:
+                saved = saved[:-1]
+            pc += 1
+        return pc, (impression, status, saved)
+
+    @staticmethod
+    def verdict(state):
+        impression, status, _ = state
+        # libpam's final sanity check: success needs a positive impression
+        if impression is not True and status == "success":
+            return must_fail_code
+        return must_fail_code if impression is None else status
+
+    def paths(self, pc, state):
+        pc, state = self.advance(pc, state)
+        if pc >= len(self.ops):
+            return [((), self.verdict(state))]
+        key = (pc, state)
+        if key not in self.memo:
+            # outcomes with the same effect share one row, "*" if all of them do
+            effects = {}
+            outcomes = self.ops[pc]["outcomes"]
+            for outcome in outcomes:
+                next_pc, next_state = self.step(pc, state, outcome)[1:]
+                effects.setdefault((next_pc, next_state), []).append(outcome)
+            rows = []
+            step = self.ops[pc]["step"]
+            for (next_pc, next_state), same in effects.items():
+                label = "*" if len(same) == len(outcomes) else "|".join(same)
+                for path, verdict in self.paths(next_pc, next_state):
+                    rows.append((((step, label),) + path, verdict))
+            self.memo[key] = rows
+        return self.memo[key]
+
+    def table(self):
+        """Every reachable combination of module outcomes and its verdict.
+
+        Modules skipped by a jump, done or die are left out of a row, so
+        their outcomes are not enumerated.
+        """
+        return [
+            {"outcomes": dict(path), "verdict": verdict}
+            for path, verdict in self.paths(0, (None, must_fail_code, ()))
+        ]
+
+    def run(self, results):
+        """Evaluate one scenario; results maps a module name or step to an outcome."""
+        trace = []
+        pc, state = self.advance(0, (None, must_fail_code, ()))
+        while pc < len(self.ops):
+            op = self.ops[pc]
+            outcome = results.get(
+                str(op["step"]), results.get(op["entry"].get("module"), "success")
+            )
+            if "error" in op["entry"]:
+                outcome = "error"
+            action, next_pc, state = self.step(pc, state, outcome)
+            trace.append({"step": op["step"], "outcome": outcome, "action": action})
+            pc, state = self.advance(next_pc, state)
+        return trace, self.verdict(state)
+
+    def summary(self, table):
+        succeed = [row for row in table if row["verdict"] == "success"]
+        return {
+            "modules": len(self.modules),
+            "paths": len(table),
+            "succeed": len(succeed),
+            # succeeds although no module reported success
+            "permissive": any(
+                not any("success" in o.split("|") for o in row["outcomes"].values())
+                for row in succeed
+            ),
+        }
+
+
+def read_pam_conf(fn, level, stype=""):
+    return PamTree().items(fn, level, stype)
+
+
+def print_analysis(analysis):
+    for name, stacks in analysis["stacks"].items():
+        for stype, items in stacks.items():
+            if not any("module" in i for i in items):
+                continue
+            print(f"== {name} {stype}")
+            for i in items:
+                print(i["prefix"] + " " + i["line"])
+            print()
+    print("== modules")
+    for module, services in analysis["modules"].items():
+        print(f"{module}: {' '.join(services)}")
+    for error in analysis["errors"]:
+        print(error, file=sys.stderr)
+
+
+def print_decision_table(name, stype, sim, table):
+    summary = sim.summary(table)
+    print(
+        f"== {name} {stype}: {summary['modules']} modules, "
+        f"{summary['paths']} paths, {summary['succeed']} succeed"
+    )
+    for op in sim.modules:
+        print(f"{op['step']:>4}  {op['entry']['fn']}: {op['entry']['line']}")
+    widths = {op["step"]: len(str(op["step"])) for op in sim.modules}
+    for row in table:
+        for step, label in row["outcomes"].items():
+            widths[step] = max(widths[step], len(label))
+    print("  ".join(str(s).ljust(w) for s, w in widths.items()) + "  verdict")
+    for row in table:
+        cells = [row["outcomes"].get(s, "-").ljust(w) for s, w in widths.items()]
+        print("  ".join(cells) + "  " + row["verdict"])
+    print()
+
+
+def parse_results(results):
+    parsed = {}
+    for result in results:
+        module, _, outcome = result.partition("=")
+        if not outcome:
+            raise SystemExit(f"--result expects MODULE=OUTCOME, got {result!r}")
+        parsed[module] = outcome.lower()
+    return parsed
+
+
+def simulate(tree, services, stype, results, as_json):
+    simulations = {}
+    for name, path in services:
+        simulations[name] = {}
+        for stype_ in [stype] if stype else stypes:
+            sim = StackSimulator(tree.expand(path, stype_)[0])
+            if not sim.modules:
+                continue
+            if results is not None:
+                trace, verdict = sim.run(results)
+                simulations[name][stype_] = {"trace": trace, "verdict": verdict}
+                if not as_json:
+                    print(f"== {name} {stype_}: {verdict}")
+                    for t in trace:
+                        entry = sim.modules[t["step"] - 1]["entry"]
+                        print(
+                            f"{t['step']:>4}  {t['outcome']:<10} {t['action']:<7} "
+                            f"{entry['line']}"
+                        )
+                    print()
+                continue
+            table = sim.table()
+            if as_json:
+                simulations[name][stype_] = {
+                    "summary": sim.summary(table),
+                    "table": table,
+                }
+            elif len(services) > 1:
+                summary = sim.summary(table)
+                print(
+                    f"{name} {stype_}: {summary['modules']} modules, "
+                    f"{summary['paths']} paths, {summary['succeed']} succeed"
+                    + (", PERMISSIVE" if summary["permissive"] else "")
+                    + ("" if summary["succeed"] else ", never succeeds")
+                )
+            else:
+                print_decision_table(name, stype_, sim, table)
+    if as_json:
+        print(json.dumps(simulations, indent=2))
+
+
+# inotify(7) events that can change a PAM file's contents or existence
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+inotify_mask = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+)
+inotify_event = struct.Struct("iIII")
+
+
+def inotify_open(dirs):
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    wds = {}
+    for d in dirs:
+        wd = libc.inotify_add_watch(fd, os.fsencode(d), inotify_mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, f"inotify_add_watch failed: {d}")
+        wds[wd] = d
+    return fd, wds
+
+
+def inotify_changes(fd, wds, debounce=0.1):
+    """Yield the sorted paths touched by each burst of inotify events."""
+    try:
+        while True:
+            changed = set()
+            ready = [fd]
+            # an editor save is several events, wait for them to settle
+            while ready:
+                data = os.read(fd, 65536)
+                offset = 0
+                while offset < len(data):
+                    wd, _, _, length = inotify_event.unpack_from(data, offset)
+                    offset += inotify_event.size
+                    name = data[offset : offset + length].rstrip(b"\0")
+                    offset += length
+                    if name and wd in wds:
+                        changed.add(os.path.join(wds[wd], os.fsdecode(name)))
+                ready = select.select([fd], [], [], debounce)[0]
+            yield sorted(changed)
+    finally:
+        os.close(fd)
+
+
+def snapshot_dirs(dirs):
+    snapshot = {}
+    for d in dirs:
+        for name in os.listdir(d):
+            path = os.path.join(d, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_mtime_ns, st.st_size)
+    return snapshot
+
+
+def poll_changes(dirs, interval):
+    """Fallback for inotify: compare mtimes and sizes every interval seconds."""
+    before = snapshot_dirs(dirs)
+    while True:
+        time.sleep(interval)
+        after = snapshot_dirs(dirs)
+        changed = [p for p in set(before) | set(after) if before.get(p) != after.get(p)]
+        before = after
+        if changed:
+            yield sorted(changed)
+
+
+def watch_changes(dirs, interval):
+    try:
+        return inotify_changes(*inotify_open(dirs))
+    except (OSError, AttributeError) as e:
+        print(f"inotify unavailable ({e}), polling every {interval}s", file=sys.stderr)
+        return poll_changes(dirs, interval)
+
+
+def capture(render, *args):
+    out = io.StringIO()
+    with redirect_stdout(out):
+        render(*args)
+    return out.getvalue()
+
+
+def watch(args, tree, man_cache):
+    """Re-render after every change in the PAM directory and print a diff.
+
+    The parsed files, memoized stacks and man page cache stay in memory, so
+    a change only re-parses the touched files and re-expands the stacks that
+    were built from them.
+    """
+    dirs = set([os.path.abspath(tree.directory)])
+    if args.conf:
+        dirs.add(os.path.dirname(os.path.abspath(args.conf)))
+    before = capture(render, args, tree, man_cache)
+    sys.stdout.write(before)
+    sys.stdout.flush()
+    try:
+        for changed in watch_changes(sorted(dirs), args.watch_interval):
+            # editor swap and backup files
+            changed = [
+                c
+                for c in changed
+                if not os.path.basename(c).startswith(".") and not c.endswith("~")
+            ]
+            if not changed:
+                continue
+            for path in changed:
+                tree.invalidate(path)
+            names = ", ".join(os.path.basename(c) for c in changed)
+            print(f"== {time.strftime('%H:%M:%S')} changed: {names}")
+            try:
+                after = capture(render, args, tree, man_cache)
+            except OSError as e:
+                # e.g. --conf between an editor's rename and write; the next
+                # change diffs against the last good output
+                print(f"error: {e}")
+                sys.stdout.flush()
+                continue
+            diff = difflib.unified_diff(
+                before.splitlines(), after.splitlines(), "before", "after", lineterm=""
+            )
+            print("\n".join(diff) or "(output unchanged)")
+            sys.stdout.flush()
+            before = after
+    except KeyboardInterrupt:
+        pass
 
 
 help_description = """
@@ -169,10 +868,44 @@ p = argparse.ArgumentParser(
     description=help_description,
     formatter_class=argparse.RawDescriptionHelpFormatter,
 )
+conf = p.add_mutually_exclusive_group(required=True)
+conf.add_argument("--conf", help="a PAM configuration file, i.e. /etc/pam.d/...")
+conf.add_argument(
+    "--all",
+    action="store_true",
+    help="analyse every service in --dir: flattened stacks per service type, "
+    "the include graph and which services reach each module",
+)
 p.add_argument(
-    "--conf", required=True, help="a PAM configuration file, i.e. /etc/pam.d/..."
+    "--dir", default=pam_dir, help="the directory that includes are resolved in"
 )
 p.add_argument("--type", default="", help="a PAM service type")
+p.add_argument(
+    "--simulate",
+    action="store_true",
+    help="evaluate the stack for every combination of module outcomes and print "
+    "the decision table; with --all, print a one line audit per service",
+)
+p.add_argument(
+    "--result",
+    action="append",
+    metavar="MODULE=OUTCOME",
+    help="with --simulate, evaluate a single scenario instead; MODULE is a module "
+    "name or step number, OUTCOME is success, fail, ignore, missing or a PAM "
+    "return value, and modules not given succeed",
+)
+p.add_argument(
+    "--watch",
+    action="store_true",
+    help="keep running, and after every change in the PAM directory print a diff "
+    "of the output; uses inotify and falls back to polling",
+)
+p.add_argument(
+    "--watch-interval",
+    type=float,
+    default=1.0,
+    help="with --watch, seconds between polls when inotify is unavailable",
+)
 p.add_argument(
     "--json", action="store_true", help="output JSON tree of the PAM evaluation"
 )
@@ -211,47 +944,85 @@ p.add_argument(
     action="store_true",
     help="when --annotate is enabled, this will only document the service type; mutually exclusive with --desc-full",
 )
+p.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="when --annotate is enabled, render every man page instead of using the cache in ~/.cache/pamtree",
+)
 p.add_argument(
     "--desc-full",
     action="store_true",
     help="when --annotate is enabled, this will include full man page documentation for the MODULE",
 )
-args = p.parse_args()
-pam_conf = read_pam_conf(args.conf, 1, args.type)
-if args.json:
-    print(json.dumps(pam_conf, indent=2))
-else:
-    man_docs = {}
-    if args.annotate:
-        if args.header:
-            print("SERVICE_TYPE  CONTROL_OPTION  MODULE_NAME  [MODULE_ARGS...]")
-        build_man_docs(man_docs, pam_conf)
-    for i in pam_conf:
-        print(i["prefix"] + " " + i["line"])
+
+
+def render(args, tree, man_cache):
+    if args.simulate:
+        results = None if args.result is None else parse_results(args.result)
+        if args.all:
+            services = [(name, tree.path(name)) for name in tree.services()]
+        else:
+            services = [(os.path.basename(args.conf), args.conf)]
+        simulate(tree, services, args.type, results, args.json)
+        return
+    if args.all:
+        analysis = tree.analyse()
+        if args.json:
+            print(json.dumps(analysis, indent=2))
+        else:
+            print_analysis(analysis)
+        return
+    pam_conf = tree.items(args.conf, 1, args.type)
+    if args.json:
+        print(json.dumps(pam_conf, indent=2))
+    else:
+        man_docs = {}
         if args.annotate:
-            if i["control"] == "include":
-                continue
-            mod_doc = man_docs[i["module"]]
-            if not args.no_name:
-                if mod_doc["name"]:
-                    print("\n" + mod_doc["name"])
-            if not args.no_desc:
-                if args.desc_stype:
-                    print("\n" + get_desc_para(mod_doc, i["stype"]))
-                elif args.desc_full:
-                    print("\n" + "\n".join(mod_doc["desc_para"]))
-                elif mod_doc["desc"]:
-                    print("\n" + mod_doc["desc"])
-            if not args.no_control:
-                stype_default = f"""<{i["stype"]} not found>"""
-                control_default = f"""<i["control"] not found>"""
-                print("\n" + man_docs["control"].get(i["stype"], stype_default))
-                print("\n" + man_docs["control"].get(i["control"], control_default))
-            if not args.no_module_args:
-                print()
-                for n in i["module_arg_names"]:
-                    print(
-                        mod_doc["options"].get(n, f"       {n}: <not found>"),
-                    )
-                # if not i["module_arg_names"]:
-                #    print()
+            if args.header:
+                print("SERVICE_TYPE  CONTROL_OPTION  MODULE_NAME  [MODULE_ARGS...]")
+            build_man_docs(man_docs, pam_conf, man_cache)
+            if not args.no_cache:
+                save_man_cache(man_cache)
+        for i in pam_conf:
+            print(i["prefix"] + " " + i["line"])
+            if args.annotate:
+                if "module" not in i:
+                    continue
+                mod_doc = man_docs[i["module"]]
+                if not args.no_name:
+                    if mod_doc["name"]:
+                        print("\n" + mod_doc["name"])
+                if not args.no_desc:
+                    if args.desc_stype:
+                        print("\n" + get_desc_para(mod_doc, i["stype"]))
+                    elif args.desc_full:
+                        print("\n" + "\n".join(mod_doc["desc_para"]))
+                    elif mod_doc["desc"]:
+                        print("\n" + mod_doc["desc"])
+                if not args.no_control:
+                    stype_default = f"""<{i["stype"]} not found>"""
+                    control_default = f"""<i["control"] not found>"""
+                    print("\n" + man_docs["control"].get(i["stype"], stype_default))
+                    print("\n" + man_docs["control"].get(i["control"], control_default))
+                if not args.no_module_args:
+                    print()
+                    for n in i["module_arg_names"]:
+                        print(
+                            mod_doc["options"].get(n, f"       {n}: <not found>"),
+                        )
+                    # if not i["module_arg_names"]:
+                    #    print()
+
+
+def main():
+    args = p.parse_args()
+    tree = PamTree(args.dir)
+    man_cache = {} if args.no_cache or not args.annotate else load_man_cache()
+    if args.watch:
+        watch(args, tree, man_cache)
+    else:
+        render(args, tree, man_cache)
+
+
+if __name__ == "__main__":
+    main()
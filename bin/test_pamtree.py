@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Tests for pamtree.py's stack simulator on fixture stacks, run it directly."""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pamtree  # noqa: E402
+
+
+class StackSimulatorTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.tree = pamtree.PamTree(self.dir)
+
+    def simulator(self, *lines):
+        path = os.path.join(self.dir, "svc")
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return pamtree.StackSimulator(self.tree.expand(path, "auth")[0])
+
+    def verdicts(self, sim):
+        return {
+            "|".join(row["outcomes"].values()): row["verdict"] for row in sim.table()
+        }
+
+    def test_required(self):
+        sim = self.simulator("auth required pam_unix.so", "auth required pam_env.so")
+        self.assertEqual(sim.run({})[1], "success")
+        self.assertEqual(sim.run({"pam_unix.so": "fail"})[1], "fail")
+        self.assertEqual(sim.run({"pam_env.so": "ignore"})[1], "success")
+
+    def test_sufficient(self):
+        sim = self.simulator("auth sufficient pam_unix.so", "auth required pam_deny.so")
+        self.assertEqual(sim.run({})[1], "success")
+        self.assertEqual(
+            sim.run({"pam_unix.so": "fail", "pam_deny.so": "fail"})[1], "fail"
+        )
+
+    def test_bad_on_success(self):
+        # libpam returns PAM_MUST_FAIL_CODE, never success, for a bad action
+        sim = self.simulator("auth [success=bad default=ok] pam_deny.so")
+        verdicts = self.verdicts(sim)
+        self.assertEqual(verdicts["success"], pamtree.must_fail_code)
+        self.assertNotIn("success", verdicts.values())
+        trace, verdict = sim.run({"pam_deny.so": "success"})
+        self.assertEqual(trace[0]["action"], "bad")
+        self.assertEqual(verdict, pamtree.must_fail_code)
+
+    def test_die_on_success(self):
+        sim = self.simulator(
+            "auth [success=die default=ignore] pam_deny.so", "auth required pam_unix.so"
+        )
+        self.assertEqual(sim.run({})[1], pamtree.must_fail_code)
+        self.assertEqual(sim.run({"pam_deny.so": "fail"})[1], "success")
+
+    def test_only_ignored(self):
+        sim = self.simulator("auth optional pam_unix.so")
+        self.assertEqual(sim.run({"pam_unix.so": "ignore"})[1], pamtree.must_fail_code)
+
+
+if __name__ == "__main__":
+    unittest.main()